@@ -0,0 +1,276 @@
+'''
+Benchmarks the markdown converters on a generated corpus.
+
+    python bench/converters.py [--sizes 1K,10K,100K,1M] [--converters beautifulsoup,native]
+                               [--save-baseline baseline.json] [--baseline baseline.json] [--check]
+
+The corpus is generated from a fixed seed, so every run converts the same documents:
+headings, paragraphs with links and inline code, lists, tables, fenced and indented
+code blocks and many local and remote images. Sizes up to 50M are supported.
+
+Every converter phase is timed separately (the best of --repeat runs), the peak
+memory is measured in a separate run with tracemalloc. With --baseline, the results
+are compared against a saved run, and the exit status is non-zero if a phase got
+slower or the peak memory grew by more than --tolerance.
+
+Before that, every converter has to turn a document with HTML written into the
+markdown (<br>, <hr>, <img>, entities and tags that are not closed) into well-formed XML, as Confluence
+rejects anything else. With --check, only that is checked.
+'''
+
+import argparse
+import json
+import os.path
+import platform
+import random
+import sys
+import tempfile
+import tracemalloc
+import xml.dom.minidom
+
+
+BIN_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bin')
+sys.path.insert(0, BIN_FOLDER)
+
+from MarkdownHtmlConverter import MarkdownHtmlConverter  # noqa: E402
+from NativeMarkdownConverter import NativeMarkdownConverter  # noqa: E402
+
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 * 1024}
+
+WORDS = ('request', 'page', 'space', 'attachment', 'version', 'token', 'markdown', 'sync',
+         'confluence', 'macro', 'digest', 'title', 'ancestor', 'upload', 'index', 'worker')
+
+# changes below this many seconds are never reported, they are noise
+MINIMUM_TIME_DIFFERENCE = 0.005
+
+# HTML written into markdown is not XHTML, but the storage format has to be
+RAW_HTML_DOCUMENT = '''# Raw HTML
+
+line one<br>line two &nbsp;&copy; &amp; <span class=note>inline</span> <img src="images/inline.png">
+
+The title is taken from the first <h1>, a lone <b> tag, <i>overlapping *tags</i>* and a stray </u>.
+
+* an <u>unclosed
+* list item</u>
+
+<hr>
+
+<div class=box>
+<img src=images/block.png alt="a&b">
+<br>
+</div>
+
+![Local](images/local.png) and ![Remote](https://example.com/remote.png)
+'''
+
+
+def parseSize(size):
+    size = size.strip().upper()
+    if size[-1:] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def generateMarkdown(size, seed=0):
+    ''' returns a markdown document of about size bytes, the same for the same seed '''
+    rng = random.Random(seed)
+    parts = ['# Generated Reference\n\nA synthetic document for benchmarking.\n\n']
+    length = len(parts[0])
+    section = 0
+    while length < size:
+        section += 1
+        part = generateSection(rng, section)
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+def generateSection(rng, section):
+    def sentence():
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 14))]
+        # inline markup
+        position = rng.randrange(len(words))
+        words[position] = rng.choice(['`{}()`', '**{}**', '*{}*', '[{}](https://example.com/{})'])\
+            .format(words[position], words[position])
+        return ' '.join(words).capitalize() + '.'
+
+    lines = ['## Section {}\n'.format(section)]
+    for paragraph in range(rng.randint(1, 3)):
+        lines.append(' '.join(sentence() for _ in range(rng.randint(2, 5))) + '\n')
+
+    choice = section % 5
+    if choice == 0:
+        lines.append('| Name | Type | Description |\n|------|------|-------------|\n' + ''.join(
+            '| `{}{}` | {} | {} |\n'.format(rng.choice(WORDS), row, rng.choice(WORDS), sentence())
+            for row in range(rng.randint(3, 12))))
+    elif choice == 1:
+        lines.append('```python\n' + ''.join(
+            'def {}_{}(value):\n    return value < {} and value & {}\n'.format(rng.choice(WORDS), line, line, line)
+            for line in range(rng.randint(3, 15))) + '```\n')
+    elif choice == 2:
+        # local images are attachments, remote ones stay as they are
+        lines.append(' '.join(
+            '![{0}](images/{0}{1}.png "{0}")'.format(rng.choice(WORDS), rng.randrange(200))
+            if rng.random() < 0.8 else '![remote](https://example.com/{}.png)'.format(image)
+            for image in range(rng.randint(2, 8))) + '\n')
+    elif choice == 3:
+        lines.append(''.join(
+            '* [{0}](files/{0}{1}.pdf) or [the wiki](https://example.com/wiki/{1})\n'.format(rng.choice(WORDS), item)
+            for item in range(rng.randint(2, 6))))
+    else:
+        lines.append(''.join(
+            '    {} = {} < {}\n'.format(rng.choice(WORDS), line, rng.choice(WORDS))
+            for line in range(rng.randint(2, 6))))
+
+    return '\n'.join(lines) + '\n'
+
+
+CONVERTERS = {
+    'beautifulsoup': MarkdownHtmlConverter,
+    'native': NativeMarkdownConverter,
+}
+
+
+def convert(converterClass, path):
+    # the converters time their phases themselves
+    converter = converterClass(path)
+    converter.timePhase('getTitle', converter.getTitle)
+    storage = converter.timePhase('prettyPrint', converter.prettyPrint)
+    return converter.phases, len(storage.encode('utf-8'))
+
+
+def checkWellFormed(converterClass, path):
+    ''' returns why the converted document is not well-formed XML, or None '''
+    storage = converterClass(path).prettyPrint()
+    try:
+        xml.dom.minidom.parseString('<page xmlns:ac="ac" xmlns:ri="ri">{}</page>'.format(storage))
+    except Exception as e:
+        return '{}\n{}'.format(e, storage)
+    return None
+
+
+def benchmark(converterClass, path, repeat, measureMemory):
+    ''' returns the best time of every phase, the peak memory and the size of the output '''
+    phases = {}
+    for _ in range(repeat):
+        runPhases, outputSize = convert(converterClass, path)
+        runPhases['total'] = sum(runPhases.values())
+        for phase, seconds in runPhases.items():
+            phases[phase] = min(seconds, phases.get(phase, seconds))
+
+    result = {'phases': phases, 'outputSize': outputSize}
+    if measureMemory:
+        tracemalloc.start()
+        try:
+            convert(converterClass, path)
+            result['peakMemory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    ''' returns the descriptions of all regressions '''
+    regressions = []
+    for case, result in results.items():
+        baselineResult = baseline.get('cases', {}).get(case)
+        if baselineResult is None:
+            continue
+        for phase, seconds in result['phases'].items():
+            baselineSeconds = baselineResult['phases'].get(phase)
+            if baselineSeconds is not None and seconds > baselineSeconds * (1 + tolerance) \
+                    and seconds - baselineSeconds > MINIMUM_TIME_DIFFERENCE:
+                regressions.append('{} {}: {:.3f} s instead of {:.3f} s (+{:.0%})'.format(
+                    case, phase, seconds, baselineSeconds, seconds / baselineSeconds - 1))
+        peakMemory = result.get('peakMemory')
+        baselinePeakMemory = baselineResult.get('peakMemory')
+        if peakMemory and baselinePeakMemory and peakMemory > baselinePeakMemory * (1 + tolerance):
+            regressions.append('{} peak memory: {:.1f} MB instead of {:.1f} MB (+{:.0%})'.format(
+                case, peakMemory / 1e6, baselinePeakMemory / 1e6, peakMemory / baselinePeakMemory - 1))
+    return regressions
+
+
+def printResult(case, result):
+    phases = result['phases']
+    print('{:<22} {}  total {:8.3f} s{}  output {:8.1f} KB'.format(
+        case,
+        '  '.join('{} {:7.3f} s'.format(phase, seconds)
+                  for phase, seconds in phases.items() if phase != 'total'),
+        phases['total'],
+        '  peak {:7.1f} MB'.format(result['peakMemory'] / 1e6) if 'peakMemory' in result else '',
+        result['outputSize'] / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the markdown converters on a generated corpus.')
+    parser.add_argument('--sizes', default='1K,10K,100K,1M',
+                        help='Comma separated document sizes, e.g. 1K,10K,100K,1M,10M,50M. (Default: 1K,10K,100K,1M)')
+    parser.add_argument('--converters', default=','.join(CONVERTERS),
+                        help='Comma separated converters to benchmark. (Default: all)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='How often each document is converted, the best time counts. (Default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus generator. (Default: 0)')
+    parser.add_argument('--no-memory', dest='measureMemory', action='store_false',
+                        help='Do not measure the peak memory, which takes another conversion.')
+    parser.add_argument('--corpus-dir', help='Directory to keep the generated corpus in. (Default: a temporary one)')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare the results to this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much slower a phase may be than in the baseline, as a fraction. (Default: 0.2)')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='Only check that the converters write well-formed XML, do not benchmark them.')
+    args = parser.parse_args()
+
+    converterNames = [name.strip() for name in args.converters.split(',')]
+    unknown = [name for name in converterNames if name not in CONVERTERS]
+    if unknown:
+        sys.exit('Error: Unknown converters {}, choose from {}.'.format(', '.join(unknown), ', '.join(CONVERTERS)))
+
+    corpusDir = args.corpus_dir or tempfile.mkdtemp(prefix='md2conf-corpus-')
+    os.makedirs(corpusDir, exist_ok=True)
+
+    rawHtmlPath = os.path.join(corpusDir, 'raw-html.md')
+    with open(rawHtmlPath, 'w') as out:
+        out.write(RAW_HTML_DOCUMENT)
+    failed = False
+    for converterName in converterNames:
+        error = checkWellFormed(CONVERTERS[converterName], rawHtmlPath)
+        if error is not None:
+            print('{} does not write well-formed XML: {}'.format(converterName, error))
+            failed = True
+    if failed:
+        sys.exit(1)
+    print('All converters write well-formed XML.')
+    if args.check:
+        return
+
+    results = {}
+    for size in args.sizes.split(','):
+        path = os.path.join(corpusDir, 'corpus-{}-{}.md'.format(size.strip(), args.seed))
+        if not os.path.exists(path):
+            with open(path, 'w') as out:
+                out.write(generateMarkdown(parseSize(size), args.seed))
+        for converterName in converterNames:
+            case = '{}/{}'.format(converterName, size.strip())
+            results[case] = benchmark(CONVERTERS[converterName], path, args.repeat, args.measureMemory)
+            printResult(case, results[case])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as out:
+            json.dump({'python': platform.python_version(), 'seed': args.seed, 'cases': results}, out, indent=2)
+        print('The results have been saved as baseline "{}".'.format(args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as inp:
+            baseline = json.load(inp)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression: {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+        print('No regressions compared to the baseline "{}".'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''
+Measures how long md2conf takes to start, compared to a bare Python interpreter.
+
+    python bench/startup.py [--runs 15] [--help-target 0.1] [--import-target 0.35]
+
+Exits with a non-zero status if the overhead exceeds a target, so it can guard
+against imports creeping back into the startup path, or if converting a document
+with the native converter imports BeautifulSoup.
+'''
+
+import argparse
+import os.path
+import statistics
+import subprocess
+import sys
+import time
+
+
+BIN_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bin')
+
+# exits with a non-zero status if a sync with the native converter would import bs4
+NATIVE_CONVERSION = '''
+import sys
+import MarkdownConfluenceSync
+from DocumentConversion import ConversionOptions, convertMarkdown, getConversionKey
+options = ConversionOptions('native', 2, False)
+getConversionKey('native.md', '# Title', options)
+convertMarkdown('native.md', '# Title\\n\\nText\\n\\n## Section\\n\\n```\\ncode\\n```\\n', options)
+sys.exit('bs4' in sys.modules)
+'''
+
+
+def measure(command, runs):
+    ''' returns the median wall clock time of running the command in seconds '''
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=BIN_FOLDER, stdout=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the startup time of md2conf.')
+    parser.add_argument('--runs', type=int, default=15, help='How often each command is run.')
+    parser.add_argument('--help-target', type=float, default=0.1,
+                        help='Maximum overhead of "md2conf.py --help" over a bare interpreter in seconds.')
+    parser.add_argument('--import-target', type=float, default=0.35,
+                        help='Maximum overhead of importing MarkdownConfluenceSync over a bare interpreter in seconds.')
+    args = parser.parse_args()
+
+    baseline = measure([sys.executable, '-c', 'pass'], args.runs)
+    results = [
+        ('md2conf.py --help',
+         measure([sys.executable, 'md2conf.py', '--help'], args.runs),
+         args.help_target),
+        ('import MarkdownConfluenceSync',
+         measure([sys.executable, '-c', 'import MarkdownConfluenceSync'], args.runs),
+         args.import_target),
+    ]
+
+    print('{:<32} {:>9}'.format('bare interpreter', '{:.0f} ms'.format(baseline * 1000)))
+    regressions = 0
+    for name, duration, target in results:
+        overhead = duration - baseline
+        verdict = 'OK' if overhead <= target else 'TOO SLOW'
+        if overhead > target:
+            regressions += 1
+        print('{:<32} {:>9} (+{:.0f} ms, target +{:.0f} ms) {}'.format(
+            name, '{:.0f} ms'.format(duration * 1000), overhead * 1000, target * 1000, verdict))
+
+    # importing it costs about as much as the rest of the startup
+    if subprocess.run([sys.executable, '-c', NATIVE_CONVERSION], cwd=BIN_FOLDER).returncode != 0:
+        print('The native converter imports BeautifulSoup.')
+        regressions += 1
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+'''
+Benchmarks syncing markdown files against the local fake Confluence.
+
+    python bench/sync.py [--pages 50] [--attachments 3] [--latency 0.02] [--jitter 0.01]
+                         [--throttle-rate 0.02] [--error-rate 0.01] [-- --workers 8]
+
+A corpus of markdown files with images is generated and synced with md2conf.py (as a
+process of its own, with the options given after "--") three times: creating all
+pages, syncing them unchanged and updating them after every page and image has
+changed. For every pass, the pages and attachments per second, the requests per
+page and the p50/p99 latency of the requests (as seen by the server, including the
+injected latency) are reported.
+'''
+
+import argparse
+import collections
+import json
+import math
+import os.path
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+BIN_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bin')
+sys.path.insert(0, BIN_FOLDER)
+
+from converters import parseSize  # noqa: E402
+from FakeConfluenceServer import FakeConfluenceServer  # noqa: E402
+
+
+SPACE_KEY = 'BENCH'
+
+PASSES = ('create', 'unchanged', 'update')
+
+
+def writeCorpus(corpusDir, pages, attachments, attachmentSize, revision):
+    ''' (re)writes the markdown files and their images, which differ for every revision '''
+    rng = random.Random(revision)
+    os.makedirs(os.path.join(corpusDir, 'images'), exist_ok=True)
+    markdownFiles = []
+    for page in range(pages):
+        lines = ['# Benchmark page {}\n'.format(page), 'Revision {}.\n'.format(revision)]
+        for attachment in range(attachments):
+            imageName = 'page{}-image{}.png'.format(page, attachment)
+            with open(os.path.join(corpusDir, 'images', imageName), 'wb') as out:
+                out.write(rng.randbytes(attachmentSize))
+            lines.append('## Figure {}\n\n![Figure {}](images/{})\n'.format(attachment, attachment, imageName))
+        lines.append('```\nprint({})\n```\n'.format(revision))
+
+        markdownFile = os.path.join(corpusDir, 'page{}.md'.format(page))
+        with open(markdownFile, 'w') as out:
+            out.write('\n'.join(lines))
+        markdownFiles.append(markdownFile)
+    return markdownFiles
+
+
+def percentile(values, fraction):
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)] if values else 0.0
+
+
+def runPass(server, markdownFiles, md2confOptions, verbose):
+    command = [sys.executable, 'md2conf.py'] + markdownFiles + [
+        SPACE_KEY, '-u', 'bench', '-p', 'bench', '--force-wiki-url', server.getWikiUrl()] + md2confOptions
+
+    server.takeRequestLog()
+    start = time.perf_counter()
+    completedProcess = subprocess.run(command, cwd=BIN_FOLDER, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                      universal_newlines=True)
+    seconds = time.perf_counter() - start
+    requestLog = server.takeRequestLog()
+
+    if verbose:
+        print(completedProcess.stdout)
+    if completedProcess.returncode != 0:
+        print(completedProcess.stdout[-2000:])
+        raise Exception('md2conf did not finish successfully.')
+
+    return seconds, requestLog
+
+
+def summarize(name, pages, seconds, requestLog):
+    statusCodes = collections.Counter(statusCode for _, _, statusCode, _ in requestLog)
+    uploads = sum(1 for method, endpoint, statusCode, _ in requestLog
+                  if method == 'POST' and endpoint.startswith('content/{id}/child/attachment') and statusCode == 200)
+    durations = [duration for _, _, _, duration in requestLog]
+    return {
+        'pass': name,
+        'seconds': seconds,
+        'pagesPerSecond': pages / seconds,
+        'attachmentsPerSecond': uploads / seconds,
+        'attachmentsUploaded': uploads,
+        'requests': len(requestLog),
+        'requestsPerPage': len(requestLog) / pages,
+        'p50': percentile(durations, 0.5),
+        'p99': percentile(durations, 0.99),
+        'throttled': statusCodes[429],
+        'failed': sum(count for statusCode, count in statusCodes.items() if statusCode >= 500),
+    }
+
+
+def printSummary(summary):
+    print('{pass:<10} {seconds:7.2f} s  {pagesPerSecond:7.1f} pages/s  {attachmentsPerSecond:7.1f} attachments/s  '
+          '{requestsPerPage:5.1f} requests/page  p50 {p50ms:6.1f} ms  p99 {p99ms:6.1f} ms  '
+          '{throttled} throttled  {failed} failed'.format(
+              p50ms=summary['p50'] * 1000, p99ms=summary['p99'] * 1000, **summary))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks syncing markdown files against the local fake Confluence. '
+                    'Options after "--" are passed to md2conf.py.')
+    parser.add_argument('--pages', type=int, default=50, help='Number of markdown files. (Default: 50)')
+    parser.add_argument('--attachments', type=int, default=3, help='Number of images per page. (Default: 3)')
+    parser.add_argument('--attachment-size', default='16K', help='Size of every image. (Default: 16K)')
+    parser.add_argument('--passes', default=','.join(PASSES),
+                        help='Comma separated passes to run, out of {}. (Default: all)'.format(', '.join(PASSES)))
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds every request is delayed by. (Default: 0.02)')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Up to this many seconds are added to the latency at random. (Default: 0.01)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of the requests answered with 429. (Default: 0)')
+    parser.add_argument('--retry-after', default='0.1', help='Retry-After of throttled requests in seconds. (Default: 0.1)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of the requests that fail. (Default: 0)')
+    parser.add_argument('--error-status', type=int, default=503, help='Status code of the failing requests. (Default: 503)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the latency and the faults. (Default: 0)')
+    parser.add_argument('--corpus-dir', help='Directory to generate the corpus in. (Default: a temporary one)')
+    parser.add_argument('--json', help='Write the results to this JSON file.')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Show the output of md2conf.')
+    parser.add_argument('md2confOptions', nargs=argparse.REMAINDER, help='Options passed to md2conf.py after "--".')
+    args = parser.parse_args()
+
+    passes = [name.strip() for name in args.passes.split(',')]
+    unknown = [name for name in passes if name not in PASSES]
+    if unknown:
+        sys.exit('Error: Unknown passes {}, choose from {}.'.format(', '.join(unknown), ', '.join(PASSES)))
+    md2confOptions = args.md2confOptions[1:] if args.md2confOptions[:1] == ['--'] else args.md2confOptions
+
+    corpusDir = args.corpus_dir or tempfile.mkdtemp(prefix='md2conf-sync-')
+    attachmentSize = parseSize(args.attachment_size)
+
+    server = FakeConfluenceServer('localhost', 0, SPACE_KEY, latency=args.latency, jitter=args.jitter,
+                                  throttleRate=args.throttle_rate, retryAfter=args.retry_after,
+                                  errorRate=args.error_rate, errorStatus=args.error_status, seed=args.seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print('Syncing {} pages with {} attachments of {} bytes each against {} ({:.0f} ms latency, '
+          '{:.0f} ms jitter, {:.0%} throttled, {:.0%} failing).'.format(
+              args.pages, args.attachments, attachmentSize, server.getWikiUrl(), args.latency * 1000,
+              args.jitter * 1000, args.throttle_rate, args.error_rate))
+
+    summaries = []
+    try:
+        revision = 0
+        markdownFiles = writeCorpus(corpusDir, args.pages, args.attachments, attachmentSize, revision)
+        for name in passes:
+            if name == 'update':
+                revision += 1
+                markdownFiles = writeCorpus(corpusDir, args.pages, args.attachments, attachmentSize, revision)
+            seconds, requestLog = runPass(server, markdownFiles, md2confOptions, args.verbose)
+            summaries.append(summarize(name, args.pages, seconds, requestLog))
+            printSummary(summaries[-1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'options': vars(args), 'passes': summaries}, out, indent=2)
+        print('The results have been saved to "{}".'.format(args.json))
+
+
+if __name__ == '__main__':
+    main()
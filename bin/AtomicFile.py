@@ -0,0 +1,25 @@
+'''
+Writing files at once, so that nobody ever reads a half written file, not even after
+an interrupted run.
+'''
+
+import os
+import os.path
+import tempfile
+
+
+def writeAtomically(path, text, permissions=None):
+    ''' writes text to a temporary file next to path and then replaces path with it '''
+    # hidden and ending in .tmp, so that nothing looking for the real files picks it up
+    fileDescriptor, temporaryPath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fileDescriptor, 'w', encoding='utf-8') as out:
+            out.write(text)
+        if permissions is not None:
+            # mkstemp creates files only their owner can read
+            os.chmod(temporaryPath, permissions)
+        os.replace(temporaryPath, path)
+    except BaseException:
+        os.remove(temporaryPath)
+        raise
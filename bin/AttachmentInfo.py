@@ -0,0 +1,8 @@
+'''
+Details of an attachment that already exists on a page.
+'''
+import collections
+
+# fingerprint is the digest md2conf recorded in the attachment comment (or None)
+AttachmentInfo = collections.namedtuple(
+    'AttachmentInfo', ['id', 'size', 'version', 'fingerprint'])
@@ -5,24 +5,92 @@ Created on Feb 2, 2017
 @author: tobias-vogel-seerene
 '''
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import json
 import mimetypes
 import os.path
-from urllib.parse import urljoin
+import threading
+from urllib.parse import quote_plus, urlencode, urljoin
 
+from AttachmentInfo import AttachmentInfo
+from ConfluenceTransport import ConfluenceTransport
+from ContentDigest import digestFile, digestPage, findDigest
+from MultipartFileStream import MultipartFileStream
 from PageInfo import PageInfo
 import requests
 
 
+# the content property that stores the digest of the uploaded content
+DIGEST_PROPERTY_KEY = 'md2conf-sync'
+
+# the number of results requested per page of paginated listings
+PAGE_SIZE = 100
+
+# the length of the query string of a CQL search for titles, which is well below the
+# URL limits of common servers and proxies (8 KB) to leave room for the rest of the
+# URL and the cursor of the next link
+MAXIMUM_QUERY_LENGTH = 6000
+
+# what has to be expanded to create a PageInfo from a result
+PAGE_EXPAND = 'version,ancestors,metadata.properties.' + DIGEST_PROPERTY_KEY
+
+
+def quoteCql(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def createTitleQueries(spacekey, titles):
+    ''' returns CQL queries that find the pages with the given titles, as few as the
+        length of the URL allows
+    '''
+    prefix = 'space = {} and type = page and title in ('.format(quoteCql(spacekey))
+    # the parameters of the search request without the titles
+    queryLength = len(urlencode({'cql': prefix + ')', 'expand': PAGE_EXPAND, 'limit': PAGE_SIZE}))
+    queries = []
+    chunk = []
+    chunkLength = queryLength
+    for title in titles:
+        titleLength = len(quote_plus(quoteCql(title) + ', '))
+        if chunk and chunkLength + titleLength > MAXIMUM_QUERY_LENGTH:
+            queries.append(prefix + ', '.join(map(quoteCql, chunk)) + ')')
+            chunk = []
+            chunkLength = queryLength
+        chunk.append(title)
+        chunkLength += titleLength
+    if chunk:
+        queries.append(prefix + ', '.join(map(quoteCql, chunk)) + ')')
+    return queries
+
+
 class ConfluenceAdapter(object):
 
-    def __init__(self, nossl, forceWikiUrl, organisation, username, password, spacekey):
+    def __init__(self, nossl, forceWikiUrl, organisation, username, password, spacekey, attachmentWorkers=4,
+                 rateLimit=None, maxRetries=5, poolSize=10, checkAuthenticationFirst=False, keepAttachmentIndexes=False):
         self.forceWikiUrl = forceWikiUrl
+        self.attachmentWorkers = attachmentWorkers
+        self.spaceIndex = None
         self.organisation = organisation
         self.spacekey = spacekey or username
         self.setUpUrls(nossl)
         self.auth = (username, password)
-        self.init_session()
+        # every request of the adapter goes through this transport (and its connection pool)
+        self.transport = ConfluenceTransport(self.auth, poolSize, rateLimit, maxRetries)
+        self.attachmentStatistics = collections.Counter()
+        self.attachmentStatisticsLock = threading.Lock()
+        # page id -> the version the page has after it has been uploaded
+        self.pageVersions = {}
+
+        # when syncing the same pages again and again, their attachments are listed
+        # only once and kept up to date with the uploads (page id -> attachment index)
+        self.keepAttachmentIndexes = keepAttachmentIndexes
+        self.attachmentIndexes = {}
+
+        # unless asked to, no extra round trip is spent on checking the
+        # credentials, the first real response tells as well
+        self.authenticated = False
+        if checkAuthenticationFirst:
+            self.init_session()
 
     def setUpUrls(self, nossl):
         if self.forceWikiUrl is None:
@@ -47,39 +115,170 @@ class ConfluenceAdapter(object):
         # step might not be required in all setups but it does not hurt,
         # either.)
 
-        self.session = requests.Session()
-        self.session.auth = self.auth
-        response = self.session.get(self.connectionTestUrl)
+        response = self.doRequest(self.prepareRequest('GET', self.connectionTestUrl))
         if response.status_code != 200:
-            errorMessage = 'Authentification against Confluence failed returning the status code {}. '.format(
-                response.status_code)
-            errorMessage += {
-                401: 'The credentials are unknown to the wiki under the url "{}".'.format(self.wikiUrl),
-                502: 'The organisation name "{}" is unknown to Atlassian.'.format(self.organisation),
-            }.get(response.status_code, 'An unknown error occurred.')
-            raise Exception(errorMessage)
+            self.raiseAuthenticationError(response)
         elif len(response.content) == 0:
             raise Exception(
                 'The response had a status code 200, but was empty. Did you specify an email address as username?')
 
-    def doRequest(self, preparedRequest):
-        preparedRequest.auth = self.auth
+    def checkAuthentication(self, response):
+        if response.status_code in (401, 403, 502):
+            self.raiseAuthenticationError(response)
+        elif response.status_code == 200 and response.request.method == 'GET' and len(response.content) == 0:
+            raise Exception(
+                'The response had a status code 200, but was empty. Did you specify an email address as username?')
+        elif response.ok:
+            self.authenticated = True
 
-        response = {
-            'GET': self.session.get(preparedRequest.url),
-            'POST': self.session.send(preparedRequest),
-            'DELETE': self.session.delete(preparedRequest.url),
-        }.get(preparedRequest.method)
+    def raiseAuthenticationError(self, response):
+        errorMessage = 'Authentification against Confluence failed returning the status code {}. '.format(
+            response.status_code)
+        errorMessage += {
+            401: 'The credentials are unknown to the wiki under the url "{}".'.format(self.wikiUrl),
+            502: 'The organisation name "{}" is unknown to Atlassian.'.format(self.organisation),
+        }.get(response.status_code, 'An unknown error occurred.')
+        raise Exception(errorMessage)
 
+    def prepareRequest(self, method, url, **kwargs):
+        return self.transport.prepareRequest(method, url, **kwargs)
+
+    def doRequest(self, preparedRequest):
+        response = self.transport.send(preparedRequest)
+        if not self.authenticated:
+            self.checkAuthentication(response)
         return response
 
+    def getAllResults(self, url, params=None):
+        # yields the results of all pages of a paginated listing
+        params = dict(params or {}, limit=PAGE_SIZE)
+        while True:
+            response = self.doRequest(self.prepareRequest('GET', url, params=params))
+            if response.status_code != 200:
+                raise Exception(
+                    'Error during request: {} (GET {})'.format(response.reason, response.url))
+
+            data = response.json()
+            yield from data['results']
+
+            nextLink = data.get('_links', {}).get('next')
+            if not nextLink or not data['results']:
+                return
+            # the next link is followed as it is, as CQL searches on Confluence Cloud
+            # are paged with a cursor instead of an offset; it is relative to the wiki
+            # and has all parameters already
+            url = urljoin(self.wikiUrl, nextLink.lstrip('/'))
+            params = None
+
+    def getPageVersion(self, pageId):
+        ''' returns the version of a page uploaded by this adapter '''
+        return self.pageVersions.get(pageId)
+
+    def printRequestStatistics(self):
+        self.transport.printStatistics()
+
+    def writeMetrics(self, path):
+        self.transport.writeMetrics(path)
+
+    def close(self):
+        self.transport.close()
+
+    def useSpaceIndex(self, spaceIndex, refresh=True):
+        # titles are resolved from the (refreshed) index from now on
+        if refresh:
+            spaceIndex.refresh(self)
+        self.spaceIndex = spaceIndex
+
+    def listPages(self):
+        return self.getAllResults(self.apiEndpointUrl, {
+            'spaceKey': self.spacekey,
+            'type': 'page',
+            'expand': PAGE_EXPAND,
+        })
+
+    def listPagesModifiedSince(self, since):
+        return self.getAllResults(urljoin(self.apiEndpointUrl + '/', 'search'), {
+            'cql': 'space = {} and type = page and lastmodified >= "{}"'.format(
+                quoteCql(self.spacekey), since.strftime('%Y-%m-%d %H:%M')),
+            'expand': PAGE_EXPAND,
+        })
+
     # Retrieve page details by title
     def getPageInfo(self, title, relationship='target'):
-        preparedRequest = requests.Request('GET', self.apiEndpointUrl, params={
+        if self.spaceIndex is not None:
+            pageInfo = self.spaceIndex.getPageInfo(title)
+            if pageInfo:
+                print('Found {} page "{}" in the space index, located at {}.'.format(
+                    relationship, title, pageInfo.link))
+                return pageInfo
+
+        pageInfo = self.lookUpPageInfo(title, relationship)
+
+        if self.spaceIndex is not None:
+            self.spaceIndex.forget(title)
+            if pageInfo:
+                self.spaceIndex.put(title, pageInfo)
+
+        return pageInfo
+
+    # Retrieve the page details of many titles at once
+    def getPageInfos(self, titles):
+        pageInfos = {}
+        titlesToLookUp = []
+        for title in dict.fromkeys(titles):
+            pageInfo = self.spaceIndex.getPageInfo(title) if self.spaceIndex is not None else None
+            if pageInfo:
+                pageInfos[title] = pageInfo
+            else:
+                titlesToLookUp.append(title)
+
+        if not titlesToLookUp:
+            return pageInfos
+
+        searchUrl = urljoin(self.apiEndpointUrl + '/', 'search')
+        queries = createTitleQueries(self.spacekey, titlesToLookUp)
+        print('Checking, which of {} pages exist (GET {}, {} queries)… '.format(
+            len(titlesToLookUp),
+            searchUrl,
+            len(queries)),
+            end='',
+            flush=True)
+
+        wantedTitles = set(titlesToLookUp)
+        results = collections.defaultdict(list)
+        foundIds = set()
+        for cql in queries:
+            for result in self.getAllResults(searchUrl, {'cql': cql, 'expand': PAGE_EXPAND}):
+                # CQL does not necessarily match titles exactly, so a page may also
+                # be found by the query for other titles
+                if result['title'] in wantedTitles and result['id'] not in foundIds:
+                    foundIds.add(result['id'])
+                    results[result['title']].append(result)
+
+        print('OK, found {}.'.format(len(results)))
+
+        for title in titlesToLookUp:
+            numberOfResults = len(results[title])
+            if numberOfResults > 1:
+                print('Found {} pages with the name "{}".'.format(numberOfResults, title))
+                raise Exception(
+                    'The page titled "{}" exists multiple times and therefore is ambiguous. Try renaming the page to create or choose another ancestor or delete it manually.'.format(title))
+
+            pageInfo = self.createPageInfo(results[title][0]) if numberOfResults else None
+            pageInfos[title] = pageInfo
+            if self.spaceIndex is not None:
+                self.spaceIndex.forget(title)
+                if pageInfo:
+                    self.spaceIndex.put(title, pageInfo)
+
+        return pageInfos
+
+    def lookUpPageInfo(self, title, relationship='target'):
+        preparedRequest = self.prepareRequest('GET', self.apiEndpointUrl, params={
             'spaceKey': self.spacekey,
-            'expand': 'version,ancestors',
+            'expand': PAGE_EXPAND,
             'title': title,
-        }).prepare()
+        })
 
         print('Checking, whether {} page "{}" exists (GET {})… '.format(
             relationship,
@@ -110,18 +309,31 @@ class ConfluenceAdapter(object):
             print('Found no pages with that name.')
             return
         elif numberOfResults == 1:
-            pageId = data['results'][0]['id']
-            versionNum = data['results'][0]['version']['number']
-            link = urljoin(
-                self.wikiUrl,
-                data['results'][0]['_links']['webui'].lstrip('/'))
-            print('Found a page with that name located at {}.'.format(link))
-            return PageInfo(pageId, versionNum, link)
+            pageInfo = self.createPageInfo(data['results'][0])
+            print('Found a page with that name located at {}.'.format(pageInfo.link))
+            return pageInfo
         else:
             print('Found {} pages with that name.'.format(numberOfResults))
             raise Exception(
                 'The page titled "{}" exists multiple times and therefore is ambiguous. Try renaming the page to create or choose another ancestor or delete it manually.'.format(title))
 
+    def createPageInfo(self, result):
+        link = urljoin(
+            self.wikiUrl,
+            result['_links']['webui'].lstrip('/'))
+
+        digest = None
+        digestPropertyVersion = None
+        digestProperty = result.get('metadata', {}).get(
+            'properties', {}).get(DIGEST_PROPERTY_KEY)
+        if digestProperty:
+            digestPropertyVersion = digestProperty['version']['number']
+            # the digest is only trustworthy if nobody changed the page afterwards
+            if digestProperty['value'].get('pageVersion') == result['version']['number']:
+                digest = digestProperty['value'].get('digest')
+
+        return PageInfo(result['id'], result['version']['number'], link, digest, digestPropertyVersion)
+
     # Delete a page
     def deletePage(self, pageInfo, title):
         if not pageInfo:
@@ -139,21 +351,165 @@ class ConfluenceAdapter(object):
             end='',
             flush=True)
 
-        preparedRequest = requests.Request('DELETE', url).prepare()
+        preparedRequest = self.prepareRequest('DELETE', url)
 
         response = self.doRequest(preparedRequest)
 
-        if response.status_code == 204:
+        # a page that has been deleted in the meantime is gone as well
+        if response.status_code in (204, 404):
             print('OK')
+            if self.spaceIndex is not None:
+                self.spaceIndex.forget(title)
         else:
             print(
                 'Failed with status code {}. Aborting.'.format(response.status_code))
+            raise Exception('The page "{}" could not be deleted (status code {}).'.format(
+                title, response.status_code))
+
+    # Delete a page and all pages below it
+    def deletePageTree(self, pageInfo, title, workers=4):
+        ''' deletes the deepest pages first, up to workers at once, and returns how many
+            pages have been deleted, could not be deleted and have been skipped, as
+            pages whose descendants could not all be deleted are kept
+        '''
+        if not pageInfo:
+            raise Exception(
+                'The page "{}" was not found and therefore cannot be deleted. There is nothing to do. Aborting.'.format(title))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # every level of the tree is listed at once: (id, title, parent id)
+            print('Listing the pages below "{}"… '.format(title), end='', flush=True)
+            levels = [[(pageInfo.id, title, None)]]
+            while True:
+                children = [child
+                            for childPages in executor.map(self.listChildPages, [pageId for pageId, _, _ in levels[-1]])
+                            for child in childPages]
+                if not children:
+                    break
+                levels.append(children)
+            print('OK, found {}.'.format(sum(len(level) for level in levels) - 1))
+
+            statistics = collections.Counter()
+            # pages that still exist, whose parents therefore must not be deleted
+            # (Confluence would move the remaining pages up instead)
+            keptIds = set()
+            for level in reversed(levels):
+                futures = []
+                for pageId, pageTitle, parentId in level:
+                    if pageId in keptIds:
+                        print('Skipping page "{}", as pages below it could not be deleted.'.format(pageTitle))
+                        statistics['skipped'] += 1
+                        keptIds.add(parentId)
+                    else:
+                        futures.append((executor.submit(self.deleteTreePage, pageId, pageTitle), pageId, parentId))
+
+                for future, pageId, parentId in futures:
+                    if future.result():
+                        statistics['deleted'] += 1
+                    else:
+                        statistics['failed'] += 1
+                        keptIds.add(parentId)
+
+        print('Deleted {} pages of the tree "{}", {} could not be deleted, {} were skipped.'.format(
+            statistics['deleted'], title, statistics['failed'], statistics['skipped']))
+        if statistics['failed']:
+            raise Exception('{} pages of the tree "{}" could not be deleted.'.format(
+                statistics['failed'] + statistics['skipped'], title))
+        return statistics
+
+    def listChildPages(self, pageId):
+        url = urljoin(self.apiEndpointUrl + '/', '{}/child/page'.format(pageId))
+        return [(child['id'], child['title'], pageId) for child in self.getAllResults(url)]
+
+    def deleteTreePage(self, pageId, title):
+        ''' returns whether the page is gone '''
+        url = urljoin(self.apiEndpointUrl + '/', pageId)
+        try:
+            response = self.doRequest(self.prepareRequest('DELETE', url))
+        except requests.RequestException as e:
+            print('Deleting page "{}" (DELETE {})… Failed: {}'.format(title, url, e))
+            return False
+
+        # deletions run concurrently, so everything is printed at once; a page that
+        # has been deleted in the meantime is gone as well
+        if response.status_code in (204, 404):
+            print('Deleting page "{}" (DELETE {})… OK'.format(title, url))
+            if self.spaceIndex is not None:
+                self.spaceIndex.forget(title)
+            return True
+        print('Deleting page "{}" (DELETE {})… Failed with status code {}'.format(title, url, response.status_code))
+        return False
+
+    def uploadPage(self, pageInfo, title, html, ancestorSnippet, retryOutdated=True):
+        digest = digestPage(title, html, ancestorSnippet)
 
-    def uploadPage(self, pageInfo, title, html, ancestorSnippet):
         if pageInfo:
-            return self.updatePage(title, html, ancestorSnippet, pageInfo)
+            if pageInfo.digest == digest:
+                print('The page "{}" is unchanged, skipping the update.'.format(title))
+                self.pageVersions[pageInfo.id] = pageInfo.version
+                return pageInfo.id
+            try:
+                pageId = self.updatePage(title, html, ancestorSnippet, pageInfo)
+            except requests.HTTPError as e:
+                # the space index may be outdated (the page has been deleted or
+                # changed in the meantime), so look the page up and try again
+                if not retryOutdated or self.spaceIndex is None or e.response.status_code not in (404, 409):
+                    raise
+                print('The space index entry of page "{}" is outdated.'.format(title))
+                self.spaceIndex.forget(title)
+                return self.uploadPage(self.lookUpPageInfo(title), title, html, ancestorSnippet, False)
+            pageVersion = pageInfo.version + 1
+            link = pageInfo.link
+        else:
+            pageId = self.createPage(title, html, ancestorSnippet)
+            pageVersion = 1
+            link = urljoin(self.wikiUrl, 'pages/viewpage.action?pageId={}'.format(pageId))
+        self.pageVersions[pageId] = pageVersion
+
+        digestPropertyVersion = self.storeDigest(pageId, pageVersion, digest, pageInfo)
+
+        if self.spaceIndex is not None:
+            self.spaceIndex.put(title, PageInfo(
+                pageId,
+                pageVersion,
+                link,
+                digest if digestPropertyVersion else None,
+                digestPropertyVersion or (pageInfo and pageInfo.digestPropertyVersion)))
+
+        return pageId
+
+    # Remember what has been uploaded, so that unchanged pages can be skipped next time
+    def storeDigest(self, pageId, pageVersion, digest, pageInfo):
+        propertyUrl = urljoin(self.apiEndpointUrl + '/', '{}/property'.format(pageId))
+        payload = {
+            'key': DIGEST_PROPERTY_KEY,
+            'value': {
+                'digest': digest,
+                'pageVersion': pageVersion,
+            },
+        }
+
+        if pageInfo and pageInfo.digestPropertyVersion:
+            method = 'PUT'
+            propertyUrl += '/' + DIGEST_PROPERTY_KEY
+            payload['version'] = {'number': pageInfo.digestPropertyVersion + 1}
         else:
-            return self.createPage(title, html, ancestorSnippet)
+            method = 'POST'
+
+        response = self.doRequest(self.prepareRequest(
+            method,
+            propertyUrl,
+            data=json.dumps(payload),
+            headers={'Content-Type': 'application/json'},
+        ))
+
+        # the page itself is fine, it only will be uploaded again next time
+        if response.status_code != 200:
+            print('Warning: The content digest of page {} could not be stored (status code {}).'.format(
+                pageId, response.status_code))
+            return None
+
+        return response.json()['version']['number']
 
     # Create a new page
     def createPage(self, title, prettyHtml, ancestorSnippet):
@@ -163,9 +519,6 @@ class ConfluenceAdapter(object):
         #prettyHtml = '<ac:image ac:alt="Deployment-dings" ac:title="This is the deployment dings"> <ri:attachment ri:filename="2015-07-13_EP-system-architecture.png" /></ac:image>'
 
         url = self.apiEndpointUrl
-        postSession = requests.Session()
-        postSession.auth = self.auth
-        postSession.headers.update({'Content-Type': 'application/json'})
 
         print('Creating the page "{}" (POST {})… '.format(
             title,
@@ -184,7 +537,12 @@ class ConfluenceAdapter(object):
                    'ancestors': ancestorSnippet
                    }
 
-        response = postSession.post(url, data=json.dumps(newPage))
+        response = self.doRequest(self.prepareRequest(
+            'POST',
+            url,
+            data=json.dumps(newPage),
+            headers={'Content-Type': 'application/json'},
+        ))
         response.raise_for_status()
 
         if response.status_code == 200:
@@ -224,11 +582,12 @@ class ConfluenceAdapter(object):
             "ancestors": ancestorSnippet,
         }
 
-        r = self.session.put(
+        r = self.doRequest(self.prepareRequest(
+            'PUT',
             url,
             data=json.dumps(payload),
             headers={'Content-Type': 'application/json'},
-        )
+        ))
         r.raise_for_status()
 
         if r.status_code == 200:
@@ -253,68 +612,130 @@ class ConfluenceAdapter(object):
             print('{} attachments have to be uploaded.'.format(
                 numberOfAttachmentsToUpload))
 
-        for normalizedPath, originalPath in normalized2OriginalPathMapping.items():
-            self.uploadAttachment(
-                sourceFolder, pageId, normalizedPath, originalPath)
-
-    def getAttachmentId(self, pageId, normalizedPath):
-        url = urljoin(self.apiEndpointUrl + '/', '{}/child/attachment/'.format(pageId))
-
-        preparedRequest = requests.Request('GET', url).prepare()
-
-        print('Checking, whether "{}" attachment exists on page {} (GET {})… '.format(
-            normalizedPath,
-            pageId,
-            preparedRequest.url))
-
-        response = self.doRequest(preparedRequest)
-
-        if response.status_code != 200:
-            raise Exception(response.reason)
-
-        atts = response.json()['results']
-        atts = list(filter(lambda a: a['title'] == normalizedPath, atts))
-        numOfAtts = len(atts)
-        if numOfAtts == 0:
-            return None
-        if numOfAtts > 1:
-            raise Exception('Found {} attachments with that name.'.format(numOfAtts))
+        # one listing of the page is enough to know about all existing attachments
+        attachmentIndex = self.lookUpAttachmentIndex(pageId)
+
+        with ThreadPoolExecutor(max_workers=self.attachmentWorkers) as executor:
+            futures = [
+                executor.submit(self.uploadAttachment, sourceFolder, pageId,
+                                normalizedPath, originalPath, attachmentIndex)
+                for normalizedPath, originalPath in normalized2OriginalPathMapping.items()
+            ]
+
+        # all uploads are finished, report the first failure (if any)
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            self.forgetAttachmentIndex(pageId)
+            raise
+
+    def lookUpAttachmentIndex(self, pageId):
+        attachmentIndex = self.attachmentIndexes.get(pageId)
+        if attachmentIndex is None:
+            attachmentIndex = self.getAttachmentIndex(pageId)
+            if self.keepAttachmentIndexes:
+                self.attachmentIndexes[pageId] = attachmentIndex
+        return attachmentIndex
+
+    def forgetAttachmentIndex(self, pageId):
+        # e.g., attachments have been deleted in the meantime, so the page is listed again
+        self.attachmentIndexes.pop(pageId, None)
+
+    def getAttachmentIndex(self, pageId):
+        url = urljoin(self.apiEndpointUrl + '/', '{}/child/attachment'.format(pageId))
+
+        print('Listing the attachments of page {} (GET {})… '.format(pageId, url),
+              end='',
+              flush=True)
 
-        fullAttId = atts[0]['id']   # eg. "att19336067"
-        return fullAttId
+        attachmentIndex = {}
+        for attachment in self.getAllResults(url, {'expand': 'version'}):
+            title = attachment['title']
+            if title in attachmentIndex:
+                print('Failed')
+                raise Exception('Found several attachments with the name "{}".'.format(title))
+
+            attachmentIndex[title] = self.createAttachmentInfo(attachment)
+
+        print('OK, found {}.'.format(len(attachmentIndex)))
+        return attachmentIndex
+
+    def createAttachmentInfo(self, attachment):
+        extensions = attachment.get('extensions', {})
+        metadata = attachment.get('metadata', {})
+        return AttachmentInfo(
+            attachment['id'],   # eg. "att19336067"
+            extensions.get('fileSize'),
+            attachment.get('version', {}).get('number'),
+            findDigest(extensions.get('comment') or metadata.get('comment')),
+        )
 
-    def uploadAttachment(self, sourceFolder, pageId, normalizedPath, originalPath):
+    def uploadAttachment(self, sourceFolder, pageId, normalizedPath, originalPath, attachmentIndex):
         sourcePath = os.path.join(sourceFolder, originalPath)
 
         url = urljoin(
             self.apiEndpointUrl + '/',
             '{}/child/attachment/'.format(pageId))
 
-        attId = self.getAttachmentId(pageId, normalizedPath)
-        if attId is not None:
-            url = url + '{}/data'.format(attId)
-
-        print('Uploading attachment {} with {} bytes (POST {})… '.format(sourcePath, os.stat(sourcePath).st_size, url),
-              end='',
-              flush=True)
-
-        contentType = mimetypes.guess_type(sourcePath)
-        comment = 'Uploaded from "{}"'.format(originalPath)
-        payload = {
-            'comment': comment,
-            'file': (normalizedPath, open(sourcePath, 'rb'), contentType, {'Expires': '0'})
-        }
+        size = os.stat(sourcePath).st_size
+        fingerprint = digestFile(sourcePath)
+
+        attachmentInfo = attachmentIndex.get(normalizedPath)
+        if attachmentInfo is not None:
+            if attachmentInfo.size == size and attachmentInfo.fingerprint == fingerprint:
+                print('Attachment {} is unchanged, skipping the upload of {} bytes.'.format(sourcePath, size))
+                self.countAttachment('skipped', size)
+                return
+            url = url + '{}/data'.format(attachmentInfo.id)
+
+        contentType = mimetypes.guess_type(sourcePath)[0] or 'application/octet-stream'
+        comment = 'Uploaded from "{}" ({})'.format(originalPath, fingerprint)
+        body = MultipartFileStream(
+            {'comment': comment},
+            'file',
+            normalizedPath,
+            sourcePath,
+            contentType,
+            {'Expires': '0'})
 
-        response = self.session.post(
+        response = self.doRequest(self.prepareRequest(
+            'POST',
             url,
-            files=payload,
-            headers={'X-Atlassian-Token': 'no-check'},
-        )
+            data=body,
+            headers={
+                'X-Atlassian-Token': 'no-check',
+                'Content-Type': body.getContentType(),
+            },
+        ))
 
+        # uploads run concurrently, so everything is printed at once
         if response.status_code == 200:
-            print('OK')
+            print('Uploading attachment {} with {} bytes (POST {})… OK'.format(sourcePath, size, url))
+            self.countAttachment('uploaded', size)
+            if self.keepAttachmentIndexes:
+                # a new attachment is returned as a list of one
+                attachment = response.json()
+                attachment = attachment['results'][0] if 'results' in attachment else attachment
+                attachmentIndex[normalizedPath] = self.createAttachmentInfo(attachment)._replace(
+                    size=size, fingerprint=fingerprint)
         else:
-            print('Failed')
+            print('Uploading attachment {} with {} bytes (POST {})… Failed'.format(sourcePath, size, url))
             raise Exception(response.reason)
 
+    def countAttachment(self, outcome, size):
+        with self.attachmentStatisticsLock:
+            self.attachmentStatistics[outcome] += 1
+            self.attachmentStatistics[outcome + 'Bytes'] += size
+
+    def printAttachmentStatistics(self):
+        with self.attachmentStatisticsLock:
+            statistics = collections.Counter(self.attachmentStatistics)
+        if statistics['uploaded'] or statistics['skipped']:
+            print('{} attachments ({} bytes) were uploaded, {} unchanged attachments were skipped, saving {} bytes.'.format(
+                statistics['uploaded'],
+                statistics['uploadedBytes'],
+                statistics['skipped'],
+                statistics['skippedBytes']))
+
 
@@ -0,0 +1,249 @@
+'''
+A markdown extension that emits the Confluence storage format directly: code blocks
+become code macros, local images and links become attachment includes.
+'''
+
+import html
+from html.parser import HTMLParser
+import re
+import xml.etree.ElementTree as etree
+
+from markdown import util
+from markdown.extensions import Extension
+from markdown.postprocessors import Postprocessor
+from markdown.treeprocessors import Treeprocessor
+
+
+# fenced code blocks are stashed as raw HTML like this by the fenced_code extension
+FENCED_CODE_BLOCK = re.compile(r'^<pre(?: [^>]*)?><code(?: [^>]*)?>([^<]*)</code></pre>$')
+
+# elements without content, which XHTML requires to be closed like <br />
+VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                           'param', 'source', 'track', 'wbr'])
+
+PLACEHOLDER = re.compile(util.HTML_PLACEHOLDER % r'([0-9]+)')
+
+
+def createCodeMacro(code):
+    ''' that is how it should look like:
+        <ac:structured-macro ac:name="code" ac:schema-version="1"><ac:plain-text-body><![CDATA[code]]></ac:plain-text-body></ac:structured-macro>
+    '''
+    return '<ac:structured-macro ac:name="code" ac:schema-version="1"><ac:plain-text-body>{}</ac:plain-text-body></ac:structured-macro>'.format(
+        createCData(code))
+
+
+def createCData(text):
+    return '<![CDATA[{}]]>'.format(text)
+
+
+def normalizeHtml(rawHtmls):
+    ''' rewrites pieces of HTML written into the markdown file as XHTML, which have to
+        be balanced together (inline HTML is stashed one tag at a time)
+
+        Start tags that are not closed and end tags that close nothing are escaped.
+    '''
+    openTags = []
+    normalizers = []
+    for rawHtml in rawHtmls:
+        normalizer = XhtmlNormalizer(openTags)
+        normalizer.feed(rawHtml)
+        normalizer.close()
+        normalizers.append(normalizer)
+    for parts, position, _, startTagText in openTags:
+        parts[position] = html.escape(startTagText, quote=False)
+    return [''.join(normalizer.parts) for normalizer in normalizers]
+
+
+def createAttachmentReference(filename):
+    # ElementTree cannot write self-closing tags other than the HTML void elements
+    return '<ri:attachment ri:filename="{}" />'.format(html.escape(filename))
+
+
+class ConfluenceStorageExtension(Extension):
+    ''' resolveReference(path) returns the name of the attachment a local path is
+        uploaded as, or None if the path is not local
+
+        The text of the first <h1> is made available as title and the heading is
+        removed from the document.
+    '''
+
+    def __init__(self, resolveReference, **kwargs):
+        self.resolveReference = resolveReference
+        self.title = None
+        self.rawHtmlBlockCount = 0
+        # indices of the raw HTML in the stash, by the element it is part of
+        self.rawHtmlGroups = []
+        super().__init__(**kwargs)
+
+    def extendMarkdown(self, md):
+        # the code macro replaces a paragraph, not just some inline content
+        md.block_level_elements.append('ac:structured-macro')
+        # after the inline patterns have created the images and links, and after
+        # escaped characters have been restored
+        md.treeprocessors.register(ConfluenceStorageTreeprocessor(md, self), 'confluence_storage', -10)
+        # before the stashed raw HTML is inserted again
+        md.postprocessors.register(StashedHtmlPostprocessor(md, self), 'confluence_stashed_html', 35)
+
+
+class ConfluenceStorageTreeprocessor(Treeprocessor):
+
+    def __init__(self, md, extension):
+        super().__init__(md)
+        self.extension = extension
+
+    def run(self, root):
+        # everything stashed so far is raw HTML from the markdown file, anything
+        # stashed from here on is already in the storage format
+        self.extension.rawHtmlBlockCount = len(self.md.htmlStash.rawHtmlBlocks)
+        if self.extension.rawHtmlBlockCount:
+            # tags have to be closed within the element they are opened in, e.g.,
+            # <b> in the text of a paragraph by </b> in the tail of a link in it
+            self.extension.rawHtmlGroups = [
+                indices for indices in map(self.getRawHtmlIndices, root.iter()) if indices]
+        parents = {child: parent for parent in root.iter() for child in parent}
+
+        # the elements are collected first, as they are changed on the way
+        for element in list(root.iter()):
+            if element.tag == 'h1' and self.extension.title is None:
+                self.extension.title = self.getText(element)
+                parents[element].remove(element)
+            elif element.tag == 'pre':
+                self.replaceCodeBlock(element)
+            elif element.tag == 'img':
+                self.replaceIncludeOfLocalImage(element)
+            elif element.tag == 'a':
+                self.replaceIncludeOfLocalAttachment(element)
+
+    def replaceCodeBlock(self, pre):
+        # indented code blocks are <pre><code>code...</code></pre>
+        if len(pre) != 1 or pre[0].tag != 'code' or len(pre[0]):
+            return
+        # markdown has escaped the code already
+        code = html.unescape(pre[0].text or '')
+        pre.remove(pre[0])
+        pre.tag = 'ac:structured-macro'
+        pre.attrib = {'ac:name': 'code', 'ac:schema-version': '1'}
+        pre.text = None
+        plainTextBody = etree.SubElement(pre, 'ac:plain-text-body')
+        plainTextBody.text = self.md.htmlStash.store(createCData(code))
+
+    def replaceIncludeOfLocalImage(self, img):
+        filename = self.extension.resolveReference(self.getAttribute(img, 'src'))
+        if filename is None:
+            return
+        attributes = {}
+        if 'alt' in img.attrib:
+            attributes['ac:alt'] = img.get('alt')
+        if 'title' in img.attrib:
+            attributes['ac:title'] = img.get('title')
+        img.tag = 'ac:image'
+        img.attrib = attributes
+        img.text = self.md.htmlStash.store(createAttachmentReference(filename))
+
+    def replaceIncludeOfLocalAttachment(self, a):
+        filename = self.extension.resolveReference(self.getAttribute(a, 'href'))
+        if filename is None:
+            return
+        # whatever was inside the original <a> tag is the link body
+        linkBody = etree.Element('ac:link-body')
+        linkBody.text = a.text
+        for child in list(a):
+            a.remove(child)
+            linkBody.append(child)
+        a.tag = 'ac:link'
+        a.attrib = {}
+        a.text = self.md.htmlStash.store(createAttachmentReference(filename))
+        a.append(linkBody)
+
+    def getRawHtmlIndices(self, element):
+        # the content of the element itself, without that of its children
+        texts = [element.text] + [child.tail for child in element]
+        return [int(index) for text in texts if text for index in PLACEHOLDER.findall(text)]
+
+    def getAttribute(self, element, name):
+        # e.g., mail addresses are obfuscated using entities
+        return html.unescape(element.get(name).replace(util.AMP_SUBSTITUTE, '&'))
+
+    def getText(self, element):
+        # inline HTML and entities are stashed, only their text is of interest
+        return PLACEHOLDER.sub(
+            lambda match: html.unescape(re.sub(r'<[^>]*>', '', str(self.md.htmlStash.rawHtmlBlocks[int(match.group(1))]))),
+            ''.join(element.itertext()))
+
+
+class StashedHtmlPostprocessor(Postprocessor):
+    ''' turns fenced code blocks into code macros and the other raw HTML (including
+        named entities, which XHTML does not know) into XHTML before the stashed HTML
+        is inserted again
+    '''
+
+    def __init__(self, md, extension):
+        super().__init__(md)
+        self.extension = extension
+
+    def run(self, text):
+        rawHtmlBlocks = self.md.htmlStash.rawHtmlBlocks
+        rawHtmlIndices = set()
+        for i in range(self.extension.rawHtmlBlockCount):
+            match = FENCED_CODE_BLOCK.match(str(rawHtmlBlocks[i]))
+            if match:
+                rawHtmlBlocks[i] = createCodeMacro(html.unescape(match.group(1)))
+            else:
+                rawHtmlIndices.add(i)
+
+        groups = [[i for i in group if i in rawHtmlIndices] for group in self.extension.rawHtmlGroups]
+        # e.g., the raw HTML of the title, which has been removed
+        groups.extend([i] for i in sorted(rawHtmlIndices.difference(*groups)))
+        for group in groups:
+            for i, normalizedHtml in zip(group, normalizeHtml([str(rawHtmlBlocks[i]) for i in group])):
+                rawHtmlBlocks[i] = normalizedHtml
+        return text
+
+
+class XhtmlNormalizer(HTMLParser):
+    ''' writes the HTML it is fed as XHTML: void elements are closed, attribute values
+        are quoted and text is escaped, so that only the XML entities are left
+
+        openTags is shared by the normalizers of HTML that is balanced together, it
+        holds the parts, position, name and text of the start tags that are still open.
+        Like in HTML, an end tag also closes the elements opened inside.
+    '''
+
+    def __init__(self, openTags):
+        super().__init__(convert_charrefs=True)
+        self.openTags = openTags
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_ELEMENTS:
+            self.openTags.append((self.parts, len(self.parts), tag, self.get_starttag_text()))
+        self.parts.append(self.formatStartTag(tag, attrs, tag in VOID_ELEMENTS))
+
+    def handle_startendtag(self, tag, attrs):
+        self.parts.append(self.formatStartTag(tag, attrs, True))
+
+    def handle_endtag(self, tag):
+        # </br> and the like have been closed already
+        if tag in VOID_ELEMENTS:
+            return
+        openTagNames = [openTag for _, _, openTag, _ in self.openTags]
+        if tag not in openTagNames:
+            self.parts.append(html.escape('</{}>'.format(tag), quote=False))
+            return
+        position = len(openTagNames) - 1 - openTagNames[::-1].index(tag)
+        for innerTag in reversed(openTagNames[position + 1:]):
+            self.parts.append('</{}>'.format(innerTag))
+        del self.openTags[position:]
+        self.parts.append('</{}>'.format(tag))
+
+    def handle_data(self, data):
+        self.parts.append(html.escape(data, quote=False))
+
+    def handle_comment(self, data):
+        self.parts.append('<!--{}-->'.format(data))
+
+    def formatStartTag(self, tag, attrs, close):
+        # attributes without value like <input disabled> are written out in XHTML
+        return '<{}{}{}>'.format(tag, ''.join(
+            ' {}="{}"'.format(name, html.escape(name if value is None else value))
+            for name, value in attrs), ' /' if close else '')
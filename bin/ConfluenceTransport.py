@@ -0,0 +1,194 @@
+'''
+The HTTP transport that all requests against Confluence go through: one session with
+a pool of keep-alive connections, rate limiting, retries, request accounting and
+metrics.
+'''
+
+import collections
+import email.utils
+import random
+import threading
+import time
+
+from HttpMetrics import HttpMetrics, getEndpointTemplate
+from RateLimiter import RateLimiter
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# responses that tell to try again later, the request has not been processed
+RETRY_STATUS_CODES = (429, 503)
+
+# responses of a gateway that tell to try again later, but the server behind it
+# might have processed the request already
+GATEWAY_RETRY_STATUS_CODES = (502, 504)
+
+# only these are sent again when the connection failed or the gateway gave up, as
+# the server might have processed the request already
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# the exponential backoff starts with this many seconds and never waits longer than the maximum
+BACKOFF_BASE = 1.0
+BACKOFF_MAXIMUM = 60.0
+
+# a Retry-After header is honoured up to this many seconds
+RETRY_AFTER_MAXIMUM = 600.0
+
+
+class ConfluenceTransport(object):
+
+    def __init__(self, auth, poolSize=10, rateLimit=None, maxRetries=5):
+        self.poolSize = poolSize
+        self.rateLimiter = RateLimiter(rateLimit) if rateLimit else None
+        self.maxRetries = maxRetries
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update({'Connection': 'keep-alive'})
+
+        # requests keeps at most poolSize connections per host; with pool_block
+        # further workers wait for a connection instead of opening (and then
+        # throwing away) additional ones
+        self.httpAdapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, pool_block=True)
+        self.session.mount('https://', self.httpAdapter)
+        self.session.mount('http://', self.httpAdapter)
+
+        self.statisticsLock = threading.Lock()
+        self.requestCounts = collections.Counter()
+        self.retryReasons = collections.Counter()
+        self.waitingSeconds = collections.Counter()
+        self.metrics = HttpMetrics()
+
+    def prepareRequest(self, method, url, **kwargs):
+        # the session adds authentication and its default headers
+        return self.session.prepare_request(requests.Request(method, url, **kwargs))
+
+    def send(self, preparedRequest):
+        # send exactly one request, whatever the verb is (unless it has to be retried)
+        settings = self.session.merge_environment_settings(
+            preparedRequest.url, {}, None, None, None)
+        endpoint = getEndpointTemplate(preparedRequest.url)
+        requestBytes = int(preparedRequest.headers.get('Content-Length') or 0)
+
+        attempt = 0
+        while True:
+            if self.rateLimiter is not None:
+                self.countWaiting('rateLimit', self.rateLimiter.acquire())
+            self.countRequest(preparedRequest)
+
+            start = time.perf_counter()
+            try:
+                response = self.session.send(preparedRequest, **settings)
+            except requests.ConnectionError as e:
+                reason = type(e).__name__
+                self.metrics.observe(preparedRequest.method, endpoint, reason,
+                                     time.perf_counter() - start, requestBytes, 0)
+                if attempt >= self.maxRetries or preparedRequest.method not in IDEMPOTENT_METHODS:
+                    raise
+                delay = self.getBackoff(attempt)
+            else:
+                # the body has been read already, unless the response is streamed
+                self.metrics.observe(preparedRequest.method, endpoint, response.status_code,
+                                     time.perf_counter() - start, requestBytes, len(response.content))
+                if attempt >= self.maxRetries or not self.isRetryable(preparedRequest, response):
+                    return response
+                delay = self.getRetryAfter(response)
+                if delay is None:
+                    delay = self.getBackoff(attempt)
+                reason = response.status_code
+                response.close()
+
+            attempt += 1
+            print('Retrying {} {} in {:.1f} seconds ({}, attempt {} of {}).'.format(
+                preparedRequest.method, preparedRequest.url, delay, reason, attempt, self.maxRetries))
+            with self.statisticsLock:
+                self.retryReasons[reason] += 1
+            self.metrics.countRetry(preparedRequest.method, endpoint, reason)
+            self.countWaiting('backoff', delay)
+            time.sleep(delay)
+
+    def isRetryable(self, preparedRequest, response):
+        if response.status_code in RETRY_STATUS_CODES:
+            return True
+        # e.g., a page created twice fails, an attachment uploaded twice gets two versions
+        return response.status_code in GATEWAY_RETRY_STATUS_CODES and preparedRequest.method in IDEMPOTENT_METHODS
+
+    def getBackoff(self, attempt):
+        # exponential backoff with jitter, so that workers do not retry in lockstep
+        delay = min(BACKOFF_MAXIMUM, BACKOFF_BASE * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def getRetryAfter(self, response):
+        # Retry-After holds either seconds or an HTTP date
+        retryAfter = response.headers.get('Retry-After')
+        if not retryAfter:
+            return None
+        try:
+            delay = float(retryAfter)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retryAfter).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(RETRY_AFTER_MAXIMUM, max(0.0, delay))
+
+    def countWaiting(self, reason, seconds):
+        if seconds:
+            with self.statisticsLock:
+                self.waitingSeconds[reason] += seconds
+
+    def countRequest(self, preparedRequest):
+        key = (preparedRequest.method, getEndpointTemplate(preparedRequest.url))
+        with self.statisticsLock:
+            self.requestCounts[key] += 1
+
+    def getRequestCounts(self):
+        with self.statisticsLock:
+            return collections.Counter(self.requestCounts)
+
+    def getPoolStatistics(self):
+        ''' returns how many connections have been opened and how many requests
+            reused an already open connection
+        '''
+        opened = 0
+        requestsSent = 0
+        pools = self.httpAdapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requestsSent += pool.num_requests
+        return {
+            'opened': opened,
+            'reused': max(0, requestsSent - opened),
+            'poolSize': self.poolSize,
+        }
+
+    def printStatistics(self):
+        requestCounts = self.getRequestCounts()
+        print('{} requests were issued against Confluence:'.format(
+            sum(requestCounts.values())))
+        for (method, endpoint), count in sorted(requestCounts.items(), key=lambda item: item[0][1]):
+            print('{:>6} {:<6} {}'.format(count, method, endpoint))
+
+        poolStatistics = self.getPoolStatistics()
+        print('{} connections were opened (pool size {}), requests reused an open connection {} times.'.format(
+            poolStatistics['opened'], poolStatistics['poolSize'], poolStatistics['reused']))
+
+        with self.statisticsLock:
+            retryReasons = collections.Counter(self.retryReasons)
+            waitingSeconds = collections.Counter(self.waitingSeconds)
+        if retryReasons:
+            print('{} requests were retried ({}), waiting {:.1f} seconds in total.'.format(
+                sum(retryReasons.values()),
+                ', '.join('{} after {}'.format(count, reason) for reason, count in retryReasons.items()),
+                waitingSeconds['backoff']))
+        if waitingSeconds['rateLimit']:
+            print('The rate limit delayed requests by {:.1f} seconds in total.'.format(
+                waitingSeconds['rateLimit']))
+
+    def writeMetrics(self, path):
+        self.metrics.writeTextfile(path)
+
+    def close(self):
+        self.session.close()
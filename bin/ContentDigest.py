@@ -0,0 +1,39 @@
+'''
+Digests that tell whether content has changed since it was uploaded the last time.
+'''
+
+import hashlib
+import json
+import re
+
+
+DIGEST_ALGORITHM = 'sha256'
+
+# files are read in chunks of this size, so that large files do not have to fit into memory
+CHUNK_SIZE = 1024 * 1024
+
+DIGEST_PATTERN = re.compile(DIGEST_ALGORITHM + r':[0-9a-f]{64}')
+
+
+def digestPage(title, storage, ancestorSnippet):
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    digest.update(title.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(storage.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(ancestorSnippet, sort_keys=True).encode('utf-8'))
+    return '{}:{}'.format(DIGEST_ALGORITHM, digest.hexdigest())
+
+
+def digestFile(path):
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return '{}:{}'.format(DIGEST_ALGORITHM, digest.hexdigest())
+
+
+def findDigest(text):
+    # returns the first digest mentioned in the text (e.g., an attachment comment) or None
+    match = DIGEST_PATTERN.search(text or '')
+    return match.group(0) if match else None
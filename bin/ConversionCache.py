@@ -0,0 +1,83 @@
+'''
+A size-bounded on-disk cache of converted markdown documents.
+'''
+
+import json
+import os
+import threading
+
+from AtomicFile import writeAtomically
+
+
+class ConversionCache(object):
+    ''' keeps one JSON file per entry, named by its key
+
+        The keys are digests of everything a conversion depends on, so entries never
+        become outdated, they are just not used anymore. Once the cache has grown
+        beyond maxSize bytes, the least recently used entries are removed.
+    '''
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        os.makedirs(path, exist_ok=True)
+
+        self.statisticsLock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def getEntryPath(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        path = self.getEntryPath(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as inp:
+                value = json.load(inp)
+            # the modification time tells when an entry has been used the last time
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, or damaged by an interrupted run
+            with self.statisticsLock:
+                self.misses += 1
+            return None
+        with self.statisticsLock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        # no worker may ever read a partial entry
+        writeAtomically(self.getEntryPath(key), json.dumps(value))
+
+    def evict(self):
+        ''' removes the least recently used entries until the cache fits into maxSize,
+            returns how many have been removed
+        '''
+        entries = []
+        with os.scandir(self.path) as directoryEntries:
+            for directoryEntry in directoryEntries:
+                if directoryEntry.name.endswith('.json'):
+                    stat = directoryEntry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, directoryEntry.path))
+
+        size = sum(entrySize for _, entrySize, _ in entries)
+        removed = 0
+        for _, entrySize, path in sorted(entries):
+            if size <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entrySize
+            removed += 1
+        return removed
+
+    def printStatistics(self, removed=0):
+        with self.statisticsLock:
+            hits, misses = self.hits, self.misses
+        print('{} of {} documents were taken from the conversion cache "{}"{}.'.format(
+            hits,
+            hits + misses,
+            self.path,
+            ', {} old entries were removed'.format(removed) if removed else ''))
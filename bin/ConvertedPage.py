@@ -0,0 +1,9 @@
+'''
+A markdown document (or a section of it) converted into the Confluence storage format.
+'''
+import collections
+
+# normalized2OriginalSrcMapping maps the names of the attachments to the paths
+# the markdown file refers to them with
+ConvertedPage = collections.namedtuple(
+    'ConvertedPage', ['title', 'storage', 'normalized2OriginalSrcMapping'])
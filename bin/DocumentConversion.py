@@ -0,0 +1,124 @@
+'''
+Converts markdown documents into the Confluence storage format.
+
+The conversion is a module-level function of plain, picklable data, so that it can
+be run in other processes.
+'''
+
+import collections
+import hashlib
+import json
+import os.path
+import time
+
+import markdown
+
+from ConvertedPage import ConvertedPage
+from MarkdownHtmlConverter import CONVERTER_VERSION, MD_EXTENSIONS, MarkdownHtmlConverter
+from MarkdownSplitter import splitMarkdown
+
+
+# the command line options that change the converted pages
+ConversionOptions = collections.namedtuple(
+    'ConversionOptions', ['converter', 'splitLevel', 'contents'])
+
+
+def getConversionKey(markdownFile, markdownText, options):
+    # everything the converted pages depend on (the file name is the title if
+    # there is no <h1>)
+    return hashlib.sha256(json.dumps([
+        CONVERTER_VERSION,
+        options.converter,
+        markdown.__version__,
+        getBeautifulSoupVersion() if options.converter == 'beautifulsoup' else None,
+        MD_EXTENSIONS,
+        options.splitLevel,
+        options.contents,
+        os.path.basename(markdownFile),
+        hashlib.sha256(markdownText.encode('utf-8')).hexdigest(),
+    ]).encode('utf-8')).hexdigest()
+
+
+def getBeautifulSoupVersion():
+    # only imported when the converter using it is used
+    import bs4
+    return bs4.__version__
+
+
+def convertMarkdownTimed(markdownFile, markdownText, options):
+    ''' returns the result of convertMarkdown and how long its phases took (in
+        seconds, summed up over all sections)
+    '''
+    phases = collections.Counter()
+    conversion = convertMarkdown(markdownFile, markdownText, options, phases)
+    return conversion, dict(phases)
+
+
+def convertMarkdown(markdownFile, markdownText, options, phases=None):
+    ''' returns the converted page and its sections (if it is split)
+
+        The time spent in each phase is added to phases if given.
+    '''
+    start = time.perf_counter()
+    if options.splitLevel:
+        introduction, sectionTexts = splitMarkdown(markdownText, options.splitLevel)
+    else:
+        introduction, sectionTexts = markdownText, []
+    if phases is not None:
+        phases['splitMarkdown'] += time.perf_counter() - start
+    markdownHtmlConverter = createConverter(markdownFile, introduction, options)
+
+    # Extract the document title
+    title = markdownHtmlConverter.timePhase('getTitle', markdownHtmlConverter.getTitle)
+
+    # each section becomes a child page, which the page links to
+    sections = convertSections(markdownFile, title, sectionTexts, options)
+    if sections:
+        markdownHtmlConverter.addChildIndex(
+            {sectionTitle: linkText for sectionTitle, linkText, _ in sections})
+
+    # Add a TOC
+    # FIXME: this currently does not work and produces garbage in the HTML
+    if options.contents:
+        markdownHtmlConverter.addContents()
+        for _, _, sectionConverter in sections:
+            sectionConverter.addContents()
+
+    conversion = createConvertedPage(title, markdownHtmlConverter), [
+        createConvertedPage(sectionTitle, sectionConverter) for sectionTitle, _, sectionConverter in sections]
+
+    if phases is not None:
+        for converter in [markdownHtmlConverter] + [sectionConverter for _, _, sectionConverter in sections]:
+            phases.update(converter.phases)
+    return conversion
+
+
+def createConvertedPage(title, markdownHtmlConverter):
+    return ConvertedPage(
+        title,
+        markdownHtmlConverter.timePhase('prettyPrint', markdownHtmlConverter.prettyPrint),
+        markdownHtmlConverter.getNormalized2OriginalSrcMapping())
+
+
+def convertSections(markdownFile, title, sectionTexts, options):
+    sections = []
+    sectionTitles = set()
+    for sectionText in sectionTexts:
+        sectionConverter = createConverter(markdownFile, sectionText, options)
+        linkText = sectionConverter.timePhase('getTitle', sectionConverter.getTitle)
+        # titles have to be unique within a space
+        sectionTitle = '{} - {}'.format(title, linkText)
+        number = 1
+        while sectionTitle in sectionTitles:
+            number += 1
+            sectionTitle = '{} - {} ({})'.format(title, linkText, number)
+        sectionTitles.add(sectionTitle)
+        sections.append((sectionTitle, linkText, sectionConverter))
+    return sections
+
+
+def createConverter(markdownFile, markdownText, options):
+    if options.converter == 'native':
+        from NativeMarkdownConverter import NativeMarkdownConverter
+        return NativeMarkdownConverter(markdownFile, markdownText)
+    return MarkdownHtmlConverter(markdownFile, markdownText)
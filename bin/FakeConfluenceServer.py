@@ -0,0 +1,429 @@
+#!/usr/bin/python3
+
+'''
+A local stand-in for the parts of the Confluence REST API that md2conf uses, so that
+syncs can be tried out without a real Confluence:
+
+    python FakeConfluenceServer.py --port 8765 --spacekey TST
+    python md2conf.py readme.md TST -u user -p password --force-wiki-url http://localhost:8765/wiki/
+
+Everything is kept in memory and any credentials are accepted. For benchmarks, every
+request can be delayed (--latency, --jitter), throttled with 429 (--throttle-rate) or
+failed (--error-rate), and all requests are logged with their status and duration.
+'''
+
+import argparse
+import base64
+import datetime
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from HttpMetrics import getEndpointTemplate
+
+CONTEXT_PATH = '/wiki'
+
+API_PATH = CONTEXT_PATH + '/rest/api/content'
+
+DEFAULT_LIMIT = 25
+
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class FakeConfluence(object):
+    ''' the state of the fake wiki: pages, their attachments and content properties '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1000)
+        self.pages = {}
+        self.attachments = {}
+        self.properties = {}
+
+    def addPage(self, spacekey, title, body='', parentId=None):
+        with self.lock:
+            page = {
+                'id': str(next(self.ids)),
+                'title': title,
+                'space': spacekey,
+                'version': 1,
+                'body': body,
+                'parentId': parentId,
+                'when': now(),
+            }
+            self.pages[page['id']] = page
+            return page
+
+    def findPages(self, spacekey=None, titles=None):
+        return [page for page in self.pages.values()
+                if (spacekey is None or page['space'] == spacekey)
+                and (titles is None or page['title'] in titles)]
+
+    def getAncestorIds(self, page):
+        ancestorIds = []
+        parentId = page['parentId']
+        while parentId in self.pages:
+            ancestorIds.insert(0, parentId)
+            parentId = self.pages[parentId]['parentId']
+        return ancestorIds
+
+    def pageToJson(self, page, expand=''):
+        data = {
+            'id': page['id'],
+            'type': 'page',
+            'status': 'current',
+            'title': page['title'],
+            'space': {'key': page['space']},
+            'version': {'number': page['version'], 'when': page['when']},
+            'ancestors': [{'id': ancestorId, 'type': 'page'} for ancestorId in self.getAncestorIds(page)],
+            '_links': {'webui': '/spaces/{}/pages/{}'.format(page['space'], page['id'])},
+        }
+        # only single content properties can be expanded, as md2conf does it
+        for key in re.findall(r'metadata\.properties\.([\w-]+)', expand):
+            contentProperty = self.properties.get((page['id'], key))
+            properties = data.setdefault('metadata', {}).setdefault('properties', {})
+            if contentProperty:
+                properties[key] = contentProperty
+        return data
+
+    def attachmentToJson(self, attachment):
+        return {
+            'id': attachment['id'],
+            'type': 'attachment',
+            'title': attachment['title'],
+            'version': {'number': attachment['version']},
+            'metadata': {'comment': attachment['comment'], 'mediaType': attachment['mediaType']},
+            'extensions': {
+                'fileSize': len(attachment['data']),
+                'comment': attachment['comment'],
+                'mediaType': attachment['mediaType'],
+            },
+        }
+
+
+class FakeConfluenceRequestHandler(BaseHTTPRequestHandler):
+
+    # keep-alive connections, like a real server
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.handleRequest('GET')
+
+    def do_POST(self):
+        self.handleRequest('POST')
+
+    def do_PUT(self):
+        self.handleRequest('PUT')
+
+    def do_DELETE(self):
+        self.handleRequest('DELETE')
+
+    def handleRequest(self, method):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.statusCode = None
+
+        if not url.path.startswith(API_PATH):
+            return self.sendJson(404, {'message': 'Not found'})
+
+        # the delay is outside of the lock, so that slow requests overlap like on a real server
+        delay = self.server.getDelay()
+        if delay:
+            time.sleep(delay)
+
+        fault = self.server.getFault()
+        if fault == 429:
+            self.sendJson(429, {'message': 'Rate limit exceeded'}, {'Retry-After': self.server.retryAfter})
+        elif fault is not None:
+            self.sendJson(fault, {'message': 'Injected error'})
+        else:
+            segments = [segment for segment in url.path[len(API_PATH):].split('/') if segment]
+            with self.server.fakeConfluence.lock:
+                self.route(method, segments)
+
+        self.server.logRequest(method, getEndpointTemplate(url.path), self.statusCode, time.perf_counter() - start)
+
+    def route(self, method, segments):
+        fakeConfluence = self.server.fakeConfluence
+
+        if not segments:
+            if method == 'GET':
+                return self.listPages()
+            if method == 'POST':
+                return self.createPage()
+        elif segments == ['search'] and method == 'GET':
+            return self.searchPages()
+        else:
+            page = fakeConfluence.pages.get(segments[0])
+            if page is None:
+                return self.sendJson(404, {'message': 'No content found with id {}'.format(segments[0])})
+
+            resource = segments[1:]
+            if not resource:
+                if method == 'GET':
+                    return self.sendJson(200, fakeConfluence.pageToJson(page, self.query.get('expand', '')))
+                if method == 'PUT':
+                    return self.updatePage(page)
+                if method == 'DELETE':
+                    return self.deletePage(page)
+            elif resource == ['child', 'page'] and method == 'GET':
+                children = [fakeConfluence.pageToJson(child) for child in fakeConfluence.pages.values()
+                            if child['parentId'] == page['id']]
+                return self.sendPaginatedJson(children)
+            elif resource == ['child', 'attachment'] and method == 'GET':
+                return self.sendPaginatedJson([
+                    fakeConfluence.attachmentToJson(attachment)
+                    for attachment in fakeConfluence.attachments.get(page['id'], [])])
+            elif resource[:2] == ['child', 'attachment'] and method == 'POST':
+                return self.uploadAttachment(page, resource[2] if len(resource) > 2 else None)
+            elif resource[0] == 'property':
+                return self.handleProperty(method, page, resource[1:])
+
+        self.sendJson(405, {'message': 'Method not supported by the fake Confluence'})
+
+    def sendJson(self, statusCode, data=None, headers=None):
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        self.statusCode = statusCode
+        self.send_response(statusCode)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendPaginatedJson(self, results, cursor=False):
+        ''' like Confluence Cloud, CQL searches are paged with an opaque cursor (given
+            cursor=True) and other listings with start
+        '''
+        if cursor:
+            start = int(base64.urlsafe_b64decode(self.query['cursor']).decode('ascii')) if 'cursor' in self.query else 0
+        else:
+            start = int(self.query.get('start', 0))
+        limit = int(self.query.get('limit', DEFAULT_LIMIT))
+        page = results[start:start + limit]
+        # the links are relative to the base url, which includes the context path
+        links = {'base': 'http://{}{}'.format(self.headers.get('Host', ''), CONTEXT_PATH), 'context': CONTEXT_PATH}
+        if start + limit < len(results):
+            query = dict(self.query, limit=limit)
+            if cursor:
+                query['cursor'] = base64.urlsafe_b64encode(str(start + limit).encode('ascii')).decode('ascii')
+            else:
+                query['start'] = start + limit
+            links['next'] = '{}?{}'.format(urlsplit(self.path).path[len(CONTEXT_PATH):], urlencode(query))
+        self.sendJson(200, {'results': page, 'start': start, 'limit': limit, 'size': len(page), '_links': links})
+
+    def listPages(self):
+        fakeConfluence = self.server.fakeConfluence
+        titles = [self.query['title']] if 'title' in self.query else None
+        pages = fakeConfluence.findPages(self.query.get('spaceKey'), titles)
+        self.sendPaginatedJson([fakeConfluence.pageToJson(page, self.query.get('expand', '')) for page in pages])
+
+    def searchPages(self):
+        ''' understands the CQL md2conf issues: space = "X" [and title in ("a", "b")] [and lastmodified >= "..."] '''
+        fakeConfluence = self.server.fakeConfluence
+        cql = self.query.get('cql', '')
+        spaceMatch = re.search(r'space\s*=\s*"((?:[^"\\]|\\.)*)"', cql)
+        titlesMatch = re.search(r'title\s+in\s*\((.*?)\)(?:\s+and|\s*$)', cql)
+        modifiedMatch = re.search(r'lastmodified\s*>=\s*"([^"]+)"', cql)
+
+        titles = None
+        if titlesMatch:
+            titles = [json.loads(title) for title in re.findall(r'"(?:[^"\\]|\\.)*"', titlesMatch.group(1))]
+        pages = fakeConfluence.findPages(json.loads('"{}"'.format(spaceMatch.group(1))) if spaceMatch else None, titles)
+        if modifiedMatch:
+            pages = [page for page in pages if page['when'][:16].replace('T', ' ') >= modifiedMatch.group(1)]
+        self.sendPaginatedJson([fakeConfluence.pageToJson(page, self.query.get('expand', '')) for page in pages], cursor=True)
+
+    def createPage(self):
+        fakeConfluence = self.server.fakeConfluence
+        data = json.loads(self.body)
+        if fakeConfluence.findPages(data['space']['key'], [data['title']]):
+            return self.sendJson(400, {'message': 'A page with this title already exists'})
+
+        ancestors = data.get('ancestors') or []
+        page = fakeConfluence.addPage(
+            data['space']['key'],
+            data['title'],
+            data['body']['storage']['value'],
+            ancestors[-1]['id'] if ancestors else None)
+        self.sendJson(200, fakeConfluence.pageToJson(page))
+
+    def updatePage(self, page):
+        data = json.loads(self.body)
+        if data['version']['number'] != page['version'] + 1:
+            return self.sendJson(409, {'message': 'Version must be incremented on update'})
+
+        page.update({
+            'title': data['title'],
+            'version': data['version']['number'],
+            'body': data['body']['storage']['value'],
+            'when': now(),
+        })
+        ancestors = data.get('ancestors') or []
+        if ancestors:
+            page['parentId'] = ancestors[-1]['id']
+        self.sendJson(200, self.server.fakeConfluence.pageToJson(page))
+
+    def deletePage(self, page):
+        fakeConfluence = self.server.fakeConfluence
+        # like Confluence, children are moved to the parent of the deleted page
+        for child in fakeConfluence.pages.values():
+            if child['parentId'] == page['id']:
+                child['parentId'] = page['parentId']
+        del fakeConfluence.pages[page['id']]
+        fakeConfluence.attachments.pop(page['id'], None)
+        self.sendJson(204)
+
+    def uploadAttachment(self, page, attachmentId):
+        fakeConfluence = self.server.fakeConfluence
+        if self.headers.get('X-Atlassian-Token') != 'no-check':
+            return self.sendJson(403, {'message': 'XSRF check failed'})
+
+        message = BytesParser().parsebytes(
+            'Content-Type: {}\r\n\r\n'.format(self.headers['Content-Type']).encode('utf-8') + self.body)
+        fields = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            fields[name] = (part.get_filename(), part.get_payload(decode=True), part.get_content_type())
+        filename, data, mediaType = fields['file']
+        comment = fields['comment'][1].decode('utf-8') if 'comment' in fields else ''
+
+        attachments = fakeConfluence.attachments.setdefault(page['id'], [])
+        if attachmentId is None:
+            if any(attachment['title'] == filename for attachment in attachments):
+                return self.sendJson(400, {'message': 'Cannot add a new attachment with same file name as an existing attachment'})
+            attachment = {'id': 'att{}'.format(next(fakeConfluence.ids)), 'title': filename, 'version': 1}
+            attachments.append(attachment)
+        else:
+            attachment = next((a for a in attachments if a['id'] == attachmentId), None)
+            if attachment is None:
+                return self.sendJson(404, {'message': 'No attachment found with id {}'.format(attachmentId)})
+            attachment['version'] += 1
+
+        attachment.update({'data': data, 'comment': comment, 'mediaType': mediaType})
+        attachmentJson = fakeConfluence.attachmentToJson(attachment)
+        self.sendJson(200, {'results': [attachmentJson]} if attachmentId is None else attachmentJson)
+
+    def handleProperty(self, method, page, resource):
+        properties = self.server.fakeConfluence.properties
+
+        if method == 'POST' and not resource:
+            data = json.loads(self.body)
+            key = data['key']
+            if (page['id'], key) in properties:
+                return self.sendJson(409, {'message': 'Property already exists'})
+            properties[(page['id'], key)] = {'key': key, 'value': data['value'], 'version': {'number': 1}}
+            return self.sendJson(200, properties[(page['id'], key)])
+        elif len(resource) == 1:
+            key = resource[0]
+            if (page['id'], key) not in properties:
+                return self.sendJson(404, {'message': 'Property not found'})
+            if method == 'GET':
+                return self.sendJson(200, properties[(page['id'], key)])
+            if method == 'PUT':
+                data = json.loads(self.body)
+                if data['version']['number'] != properties[(page['id'], key)]['version']['number'] + 1:
+                    return self.sendJson(409, {'message': 'Version must be incremented on update'})
+                properties[(page['id'], key)] = {'key': key, 'value': data['value'], 'version': data['version']}
+                return self.sendJson(200, properties[(page['id'], key)])
+
+        self.sendJson(405, {'message': 'Method not supported by the fake Confluence'})
+
+
+class FakeConfluenceServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=8765, spacekey='TST', verbose=False, latency=0.0, jitter=0.0,
+                 throttleRate=0.0, retryAfter='1', errorRate=0.0, errorStatus=503, seed=None):
+        ''' every API request is delayed by latency plus up to jitter seconds, a share of
+            throttleRate of them is answered with 429 (and the Retry-After header), a share
+            of errorRate fails with errorStatus
+        '''
+        ThreadingHTTPServer.__init__(self, (host, port), FakeConfluenceRequestHandler)
+        self.verbose = verbose
+        self.fakeConfluence = FakeConfluence()
+        self.fakeConfluence.addPage(spacekey, 'Home')
+
+        self.latency = latency
+        self.jitter = jitter
+        self.throttleRate = throttleRate
+        self.retryAfter = str(retryAfter)
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+        self.random = random.Random(seed)
+        self.randomLock = threading.Lock()
+
+        # (method, endpoint template, status code, seconds) of every API request
+        self.requestLog = []
+        self.requestLogLock = threading.Lock()
+
+    def getWikiUrl(self):
+        return 'http://{}:{}/wiki/'.format(*self.server_address[:2])
+
+    def getDelay(self):
+        if not self.jitter:
+            return self.latency
+        with self.randomLock:
+            return self.latency + self.random.uniform(0, self.jitter)
+
+    def getFault(self):
+        ''' returns the status code of the injected fault, if any '''
+        if not self.throttleRate and not self.errorRate:
+            return None
+        with self.randomLock:
+            chance = self.random.random()
+        if chance < self.throttleRate:
+            return 429
+        if chance < self.throttleRate + self.errorRate:
+            return self.errorStatus
+        return None
+
+    def logRequest(self, method, endpoint, statusCode, seconds):
+        with self.requestLogLock:
+            self.requestLog.append((method, endpoint, statusCode, seconds))
+
+    def takeRequestLog(self):
+        ''' returns the requests logged so far and starts a new log '''
+        with self.requestLogLock:
+            requestLog, self.requestLog = self.requestLog, []
+        return requestLog
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost', help='Interface to listen on. (Default: localhost)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on. (Default: 8765)')
+    parser.add_argument('--spacekey', default='TST', help='Key of the space that is created with a "Home" page. (Default: TST)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Log every request.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every request is delayed by. (Default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many seconds are added to the latency at random. (Default: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of the requests answered with 429, e.g. 0.05. (Default: 0)')
+    parser.add_argument('--retry-after', default='1', help='Value of the Retry-After header of throttled requests. (Default: 1)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of the requests that fail, e.g. 0.01. (Default: 0)')
+    parser.add_argument('--error-status', type=int, default=503, help='Status code of the failing requests. (Default: 503)')
+    parser.add_argument('--seed', type=int, help='Seed of the random latency and faults, for reproducible runs.')
+    args = parser.parse_args()
+
+    server = FakeConfluenceServer(args.host, args.port, args.spacekey, args.verbose, args.latency, args.jitter,
+                                  args.throttle_rate, args.retry_after, args.error_rate, args.error_status, args.seed)
+    print('Fake Confluence is listening, use --force-wiki-url {}'.format(server.getWikiUrl()), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
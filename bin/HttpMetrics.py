@@ -0,0 +1,122 @@
+'''
+Metrics of the HTTP requests against Confluence (latency, bytes, status codes and
+retries per endpoint), written in the Prometheus text format, e.g., for the textfile
+collector of the node exporter.
+'''
+
+import bisect
+import collections
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+from AtomicFile import writeAtomically
+
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def getEndpointTemplate(url):
+    ''' returns the endpoint of the Confluence API that the url (or path) is for, with
+        placeholders instead of ids, so that all requests against the same kind of
+        resource are counted together, e.g., "content/{id}/child/attachment/{attachmentId}/data"
+    '''
+    path = urlsplit(url).path
+    path = path[path.find('rest/api/') + len('rest/api/'):]
+    path = re.sub(r'(?<=/)att\d+(?=/|$)', '{attachmentId}', path)
+    path = re.sub(r'(?<=/)\d+(?=/|$)', '{id}', path)
+    return path.rstrip('/')
+
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+def formatValue(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class HttpMetrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (method, endpoint) -> count per bucket (the last one is +Inf)
+        self.latencyBuckets = collections.defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.latencySums = collections.Counter()
+        # (method, endpoint, status code)
+        self.responses = collections.Counter()
+        self.requestBytes = collections.Counter()
+        self.responseBytes = collections.Counter()
+        # (method, endpoint, reason)
+        self.retries = collections.Counter()
+
+    def observe(self, method, endpoint, status, seconds, requestBytes, responseBytes):
+        ''' status is the status code or, if no response was received, the name of the error '''
+        key = (method, endpoint)
+        with self.lock:
+            self.latencyBuckets[key][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.latencySums[key] += seconds
+            self.responses[(method, endpoint, status)] += 1
+            self.requestBytes[key] += requestBytes
+            self.responseBytes[key] += responseBytes
+
+    def countRetry(self, method, endpoint, reason):
+        with self.lock:
+            self.retries[(method, endpoint, reason)] += 1
+
+    def formatText(self):
+        ''' returns all metrics in the Prometheus text exposition format '''
+        lines = []
+
+        def addMetric(name, metricType, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, metricType))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(name, suffix, formatLabels(labels), formatValue(value)))
+
+        with self.lock:
+            histogramSamples = []
+            for (method, endpoint), buckets in sorted(self.latencyBuckets.items()):
+                labels = [('method', method), ('endpoint', endpoint)]
+                cumulativeCount = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                    cumulativeCount += count
+                    histogramSamples.append(('_bucket', labels + [('le', bound)], cumulativeCount))
+                histogramSamples.append(('_sum', labels, self.latencySums[(method, endpoint)]))
+                histogramSamples.append(('_count', labels, cumulativeCount))
+            addMetric('md2conf_http_request_duration_seconds', 'histogram',
+                      'Latency of the requests against Confluence, including the response body.',
+                      histogramSamples)
+
+            addMetric('md2conf_http_responses_total', 'counter',
+                      'Responses by status code (or error, if there was no response).',
+                      [('', [('method', method), ('endpoint', endpoint), ('code', status)], count)
+                       for (method, endpoint, status), count in sorted(self.responses.items(), key=str)])
+            addMetric('md2conf_http_request_bytes_total', 'counter',
+                      'Bytes sent in request bodies.',
+                      [('', [('method', method), ('endpoint', endpoint)], count)
+                       for (method, endpoint), count in sorted(self.requestBytes.items())])
+            addMetric('md2conf_http_response_bytes_total', 'counter',
+                      'Bytes received in response bodies.',
+                      [('', [('method', method), ('endpoint', endpoint)], count)
+                       for (method, endpoint), count in sorted(self.responseBytes.items())])
+            addMetric('md2conf_http_retries_total', 'counter',
+                      'Requests that were sent again, by the reason of the retry.',
+                      [('', [('method', method), ('endpoint', endpoint), ('reason', reason)], count)
+                       for (method, endpoint, reason), count in sorted(self.retries.items(), key=str)])
+
+        addMetric('md2conf_last_run_timestamp_seconds', 'gauge',
+                  'When the metrics have been written.',
+                  [('', [], time.time())])
+        return '\n'.join(lines) + '\n'
+
+    def writeTextfile(self, path):
+        # the collector must never read a half written file, and has to be able to read it
+        writeAtomically(path, self.formatText(), 0o644)
+        print('The request metrics have been written to "{}".'.format(path))
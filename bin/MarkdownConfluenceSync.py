@@ -4,18 +4,26 @@ Created on Jan 31, 2017
 @author: tobias-vogel-seerene
 '''
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import os
 import os.path
+import threading
+import time
 
 from ConfluenceAdapter import ConfluenceAdapter
-from MarkdownHtmlConverter import MarkdownHtmlConverter
+from ConvertedPage import ConvertedPage
+from DocumentConversion import ConversionOptions, convertMarkdownTimed, getConversionKey
+from MarkdownFiles import collectMarkdownFiles
+from MarkdownHtmlConverter import CONVERTER_VERSION
+from PhaseTimer import PhaseTimer
 
 
 class MarkdownConfluenceSync(object):
 
     def __init__(self, args):
         self.args = args
-        self.sourceFolder = os.path.dirname(
-            os.path.abspath(self.args.markdownFile))
+        self.phaseTimer = PhaseTimer()
 
         self.confluenceAdapter = ConfluenceAdapter(
             args.nossl,
@@ -24,58 +32,447 @@ class MarkdownConfluenceSync(object):
             args.username,
             args.password,
             args.spacekey,
+            attachmentWorkers=args.attachment_workers,
+            rateLimit=args.rate_limit,
+            maxRetries=args.max_retries,
+            # every worker may be uploading attachments
+            poolSize=args.pool_size or args.workers * args.attachment_workers,
+            checkAuthenticationFirst=args.check_auth,
+            keepAttachmentIndexes=args.watch,
         )
 
+        # modules of optional features are only imported when they are used,
+        # which keeps the startup fast
+        self.spaceIndex = None
+        if args.space_index:
+            from SpaceIndex import SpaceIndex
+            self.spaceIndex = SpaceIndex(args.space_index, args.spacekey)
+            self.confluenceAdapter.useSpaceIndex(self.spaceIndex)
+        elif args.watch:
+            # the pages that have been resolved or uploaded are remembered while watching
+            from SpaceIndex import SpaceIndex
+            self.spaceIndex = SpaceIndex(':memory:', args.spacekey)
+            self.confluenceAdapter.useSpaceIndex(self.spaceIndex, refresh=False)
+
+        self.conversionOptions = ConversionOptions(args.converter, args.split_level, args.contents)
+        self.conversionProcesses = 0
+        self.processPool = None
+
+        self.conversionCache = None
+        if args.cache_dir:
+            from ConversionCache import ConversionCache
+            self.conversionCache = ConversionCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+        self.syncManifest = None
+        if args.manifest:
+            from SyncManifest import SyncManifest
+            # the manifest is useless if the pages end up elsewhere or look different
+            self.syncManifest = SyncManifest(args.manifest, [
+                CONVERTER_VERSION,
+                self.confluenceAdapter.wikiUrl,
+                args.spacekey,
+                args.ancestor,
+                list(self.conversionOptions),
+            ])
+        # markdown file -> state of it and its attachments before it was synced
+        self.syncStates = {}
+        # markdown file -> (title, id) of its page and the pages of its sections
+        self.syncedPages = {}
+        # markdown file -> absolute paths of its attachments, as of its last conversion
+        self.attachmentPaths = {}
+
+        # the parent page is resolved only once, no matter how many documents are synced
+        self.ancestorSnippet = None
+        self.ancestorLock = threading.Lock()
+
+        # titles that have been resolved in advance
+        self.resolvedPageInfos = {}
+
     def run(self):
-        self.markdownHtmlConverter = MarkdownHtmlConverter(
-            self.args.markdownFile)
+        markdownFiles = self.selectMarkdownFiles(self.args.markdownFiles)
+        self.startConversionProcesses(len(markdownFiles))
+        try:
+            failures = self.syncMarkdownFiles(markdownFiles)
+        finally:
+            self.finish()
+        self.reportFailures(failures, len(markdownFiles))
+        self.printGoodByeMessage()
 
-        # Extract the document title
-        self.title = self.markdownHtmlConverter.getTitle()
+    def watch(self):
+        ''' syncs the markdown files, then syncs again whatever of them (or of their
+            attachments) changes until interrupted
 
-        self.printWelcomeMessage()
+            The session, the pages resolved before and the attachment listings are
+            kept, so that a change costs only the requests that upload it.
+        '''
+        markdownFiles = self.args.markdownFiles
+        self.startConversionProcesses(len(markdownFiles))
+        try:
+            snapshot = self.takeSnapshot(markdownFiles)
+            self.syncWatchedFiles(self.selectMarkdownFiles(markdownFiles), snapshot)
+            print('Watching {} markdown files and their attachments for changes, press Ctrl+C to stop.'.format(
+                len(markdownFiles)))
 
-        # Add a TOC
-        # FIXME: this currently does not work and produces garbage in the HTML
-        if self.args.contents:
-            self.markdownHtmlConverter.addContents()
+            while True:
+                time.sleep(self.args.watch_interval)
+                try:
+                    # new files are picked up as well
+                    markdownFiles = collectMarkdownFiles(self.args.markdownPaths)
+                except Exception as e:
+                    print('Warning: {}'.format(e))
+                    continue
 
-        targetPageInfo = self.confluenceAdapter.getPageInfo(self.title)
+                changedSnapshot = self.takeSnapshot(markdownFiles)
+                if changedSnapshot == snapshot:
+                    continue
+                # wait for the end of a burst of saves
+                changedSnapshot = self.waitUntilSettled(markdownFiles, changedSnapshot)
+                changedFiles = [markdownFile for markdownFile in markdownFiles
+                                if any(snapshot.get(path) != changedSnapshot.get(path)
+                                       for path in self.getWatchedPaths(markdownFile))]
+                snapshot = changedSnapshot
+                self.syncWatchedFiles(changedFiles, snapshot)
+        except KeyboardInterrupt:
+            print('Stopped watching.')
+        finally:
+            self.finish()
 
-        if self.args.delete:
-            self.confluenceAdapter.deletePage(targetPageInfo, self.title)
+    def syncWatchedFiles(self, markdownFiles, snapshot):
+        if not markdownFiles:
+            return
+        failures = self.syncMarkdownFiles(markdownFiles)
+        for markdownFile, exception in failures.items():
+            print('Syncing "{}" failed: {}'.format(markdownFile, exception))
+        print('Synced {} of {} changed markdown files.'.format(len(markdownFiles) - len(failures), len(markdownFiles)))
+        # attachments that are referenced for the first time have not been watched
+        # before, they are as they were when they were synced
+        for path, fileState in self.takeSnapshot(markdownFiles).items():
+            snapshot.setdefault(path, fileState)
+        # files that failed, e.g., because Confluence was unavailable for a moment,
+        # count as changed until they have been synced
+        for markdownFile in failures:
+            for path in self.getWatchedPaths(markdownFile):
+                snapshot.pop(path, None)
+
+    def getWatchedPaths(self, markdownFile):
+        attachmentPaths = self.attachmentPaths.get(markdownFile)
+        # files skipped thanks to the manifest have not been converted
+        if attachmentPaths is None and self.syncManifest is not None:
+            attachmentPaths = self.syncManifest.getAttachmentPaths(markdownFile)
+        return [markdownFile] + (attachmentPaths or [])
+
+    def takeSnapshot(self, markdownFiles):
+        ''' returns the modification time and size of the markdown files and their attachments '''
+        snapshot = {}
+        for markdownFile in markdownFiles:
+            for path in self.getWatchedPaths(markdownFile):
+                try:
+                    stat = os.stat(path)
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    snapshot[path] = None
+        return snapshot
+
+    def waitUntilSettled(self, markdownFiles, snapshot):
+        while True:
+            time.sleep(self.args.debounce)
+            settledSnapshot = self.takeSnapshot(markdownFiles)
+            if settledSnapshot == snapshot:
+                return settledSnapshot
+            snapshot = settledSnapshot
+
+    def startConversionProcesses(self, numberOfFiles):
+        # converting is CPU bound, so several documents are converted in
+        # processes of their own
+        self.conversionProcesses = min(self.args.conversion_workers or os.cpu_count() or 1, numberOfFiles)
+        if self.conversionProcesses > 1:
+            # forking a process with running threads is unsafe
+            self.processPool = ProcessPoolExecutor(
+                max_workers=self.conversionProcesses, mp_context=multiprocessing.get_context('spawn'))
+
+    def syncMarkdownFiles(self, markdownFiles):
+        ''' returns the markdown files that could not be synced, with the reason '''
+        # pages resolved in advance for other files may have changed in the meantime
+        self.resolvedPageInfos = {}
+
+        if not markdownFiles:
+            failures = {}
         else:
-            self.ancestorSnippet = self.getAncestorsSnippet()
+            if len(markdownFiles) > 1:
+                print('Syncing {} markdown files using {} workers.'.format(
+                    len(markdownFiles), self.args.workers))
+            failures = self.runThreaded(markdownFiles)
 
-            pageId = self.confluenceAdapter.uploadPage(
-                targetPageInfo,
-                self.title,
-                self.markdownHtmlConverter.prettyPrint(),
-                self.ancestorSnippet,
-            )
+        if self.syncManifest is not None:
+            self.updateSyncManifest(markdownFiles, failures)
+        return failures
 
-            self.confluenceAdapter.uploadAttachments(
-                self.sourceFolder,
-                pageId,
-                self.markdownHtmlConverter.getNormalized2OriginalSrcMapping())
+    def finish(self):
+        if self.processPool is not None:
+            self.processPool.shutdown()
 
-        self.printGoodByeMessage()
+        if self.spaceIndex is not None:
+            self.spaceIndex.close()
+
+        if self.conversionCache is not None:
+            self.conversionCache.printStatistics(self.conversionCache.evict())
+
+        self.confluenceAdapter.printAttachmentStatistics()
+        self.confluenceAdapter.printRequestStatistics()
+        if self.args.metrics_file:
+            self.confluenceAdapter.writeMetrics(self.args.metrics_file)
+        self.confluenceAdapter.close()
+
+        if self.args.timing_report:
+            self.phaseTimer.writeReport(self.args.timing_report)
+
+    def reportFailures(self, failures, numberOfFiles):
+        if failures:
+            for markdownFile, exception in failures.items():
+                print('Syncing "{}" failed: {}'.format(markdownFile, exception))
+            raise Exception('{} of {} markdown files could not be synced.'.format(
+                len(failures), numberOfFiles))
+
+    def selectMarkdownFiles(self, markdownFiles):
+        ''' returns the markdown files that have to be synced '''
+        if self.args.since:
+            from MarkdownFiles import getFilesChangedSince
+            changedFiles = getFilesChangedSince(self.args.since, markdownFiles)
+            numberOfFiles = len(markdownFiles)
+            # a file also has to be synced if one of its attachments has changed
+            markdownFiles = [
+                markdownFile for markdownFile in markdownFiles
+                if any(os.path.realpath(path) in changedFiles for path in [markdownFile] + (
+                    self.syncManifest.getAttachmentPaths(markdownFile) if self.syncManifest is not None else []))]
+            print('{} of {} markdown files have changed since revision "{}".'.format(
+                len(markdownFiles), numberOfFiles, self.args.since))
+
+        # deleted pages are deleted again, whatever the manifest says
+        if self.syncManifest is not None and not self.args.delete:
+            numberOfFiles = len(markdownFiles)
+            markdownFiles = [markdownFile for markdownFile in markdownFiles
+                             if self.syncManifest.hasChanged(markdownFile)]
+            print('{} of {} markdown files have changed since they have been synced the last time (according to "{}").'.format(
+                len(markdownFiles), numberOfFiles, self.args.manifest))
+        return markdownFiles
+
+    def updateSyncManifest(self, markdownFiles, failures):
+        for markdownFile in markdownFiles:
+            if markdownFile in failures:
+                continue
+            if self.args.delete:
+                self.syncManifest.forget(markdownFile)
+            elif markdownFile in self.syncStates and markdownFile in self.syncedPages:
+                markdownState, attachmentStates = self.syncStates[markdownFile]
+                self.syncManifest.record(markdownFile, markdownState, attachmentStates, [
+                    (title, pageId, self.confluenceAdapter.getPageVersion(pageId)) for title, pageId in self.syncedPages[markdownFile]])
+        self.syncManifest.save()
+
+    def runThreaded(self, markdownFiles):
+        failures = {}
+        # every conversion process is waited for by a thread
+        with ThreadPoolExecutor(max_workers=max(self.args.workers, self.conversionProcesses)) as executor:
+            conversions = self.collectResults(
+                {markdownFile: executor.submit(self.convertDocument, markdownFile)
+                 for markdownFile in markdownFiles},
+                failures)
+
+        with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+            # all titles are known now, so they are resolved at once
+            with self.phaseTimer.measure('resolvePageInfos'):
+                self.resolvePageInfos(self.getTitles(conversions))
+
+            pageIds = self.collectResults(
+                {markdownFile: executor.submit(self.syncDocument, markdownFile, convertedPage)
+                 for markdownFile, (convertedPage, _) in conversions.items()},
+                failures)
+
+            # the sections of split documents are children of the pages synced before
+            sectionFailures = {}
+            sectionPageIds = self.collectResults(
+                {(markdownFile, section.title): executor.submit(
+                    self.syncDocument, markdownFile, section,
+                    self.createSectionAncestorsSnippet(pageIds[markdownFile]))
+                 for markdownFile, section in self.getSections(conversions, pageIds)},
+                sectionFailures)
+            self.collectSectionFailures(sectionFailures, failures)
+        self.rememberSyncedPages(conversions, pageIds, sectionPageIds)
+        return failures
+
+    def collectResults(self, futures, failures):
+        results = {}
+        for markdownFile, future in futures.items():
+            exception = future.exception()
+            if exception is not None:
+                failures[markdownFile] = exception
+            else:
+                results[markdownFile] = future.result()
+        return results
+
+    def getTitles(self, conversions):
+        titles = []
+        for convertedPage, sections in conversions.values():
+            titles.append(convertedPage.title)
+            titles.extend(section.title for section in sections)
+        return titles
+
+    def getSections(self, conversions, pageIds):
+        # the sections have been deleted together with their page
+        if self.args.delete and self.args.recursive:
+            return []
+        # no sections are synced for documents whose page could not be synced
+        return [(markdownFile, section)
+                for markdownFile, (_, sections) in conversions.items() if markdownFile in pageIds
+                for section in sections]
+
+    def collectSectionFailures(self, sectionFailures, failures):
+        for (markdownFile, sectionTitle), exception in sectionFailures.items():
+            print('Syncing the section "{}" of "{}" failed: {}'.format(sectionTitle, markdownFile, exception))
+            failures.setdefault(markdownFile, Exception(
+                'The section "{}" could not be synced: {}'.format(sectionTitle, exception)))
+
+    def rememberSyncedPages(self, conversions, pageIds, sectionPageIds):
+        for markdownFile, (convertedPage, sections) in conversions.items():
+            if markdownFile in pageIds:
+                self.syncedPages[markdownFile] = [(convertedPage.title, pageIds[markdownFile])] + [
+                    (section.title, sectionPageIds.get((markdownFile, section.title))) for section in sections]
+
+    def resolvePageInfos(self, titles):
+        if self.args.ancestor:
+            titles = titles + [self.args.ancestor]
+        if len(titles) < 2:
+            return
+
+        try:
+            self.resolvedPageInfos = self.confluenceAdapter.getPageInfos(titles)
+        except Exception as e:
+            # e.g., ambiguous titles, which only the affected documents should fail for
+            print('Resolving the titles at once failed ({}), they will be looked up one by one.'.format(e))
+
+    def getPageInfo(self, title, relationship='target'):
+        if title in self.resolvedPageInfos:
+            return self.resolvedPageInfos[title]
+        return self.confluenceAdapter.getPageInfo(title, relationship)
+
+    def convertDocument(self, markdownFile):
+        ''' returns the converted page and its sections (if it is split) '''
+        # taken before reading, so that changes from now on are noticed next time
+        markdownState = self.syncManifest.captureFileState(markdownFile) if self.syncManifest is not None else None
+
+        with self.phaseTimer.measure('convert', markdownFile):
+            conversion = self.readAndConvertDocument(markdownFile)
+
+        if self.syncManifest is not None:
+            self.captureSyncState(markdownFile, markdownState, conversion)
+
+        sourceFolder = os.path.dirname(os.path.abspath(markdownFile))
+        self.attachmentPaths[markdownFile] = [
+            os.path.join(sourceFolder, originalPath)
+            for page in [conversion[0]] + conversion[1]
+            for originalPath in page.normalized2OriginalSrcMapping.values()]
+
+        convertedPage, sections = conversion
+        self.printWelcomeMessage(markdownFile, convertedPage.title)
+        if sections:
+            print('Splitting "{}" into {} sections.'.format(markdownFile, len(sections)))
+        return convertedPage, sections
+
+    def captureSyncState(self, markdownFile, markdownState, conversion):
+        sourceFolder = os.path.dirname(os.path.abspath(markdownFile))
+        convertedPage, sections = conversion
+        attachmentStates = {}
+        try:
+            for page in [convertedPage] + sections:
+                for originalPath in page.normalized2OriginalSrcMapping.values():
+                    attachmentStates[originalPath] = self.syncManifest.captureFileState(
+                        os.path.join(sourceFolder, originalPath))
+        except OSError:
+            # the upload of the attachment is going to fail
+            return
+        self.syncStates[markdownFile] = (markdownState, attachmentStates)
+
+    def readAndConvertDocument(self, markdownFile):
+        with open(markdownFile, 'r') as inp:
+            markdownText = inp.read()
+
+        if self.conversionCache is not None:
+            conversionKey = getConversionKey(markdownFile, markdownText, self.conversionOptions)
+            conversion = self.conversionCache.get(conversionKey)
+            if conversion is not None:
+                # JSON turned the named tuples into lists
+                return ConvertedPage(*conversion[0]), [ConvertedPage(*section) for section in conversion[1]]
+
+        if self.processPool is not None:
+            conversion, phases = self.processPool.submit(
+                convertMarkdownTimed, markdownFile, markdownText, self.conversionOptions).result()
+        else:
+            conversion, phases = convertMarkdownTimed(markdownFile, markdownText, self.conversionOptions)
+        self.phaseTimer.addConversionPhases(markdownFile, phases)
+
+        if self.conversionCache is not None:
+            self.conversionCache.put(conversionKey, conversion)
+        return conversion
+
+    def syncDocument(self, markdownFile, convertedPage, ancestorSnippet=None):
+        ''' returns the id of the page, or None if it has been deleted '''
+        sourceFolder = os.path.dirname(os.path.abspath(markdownFile))
+
+        with self.phaseTimer.measure('getPageInfo', markdownFile):
+            targetPageInfo = self.getPageInfo(convertedPage.title)
+
+        if self.args.delete:
+            with self.phaseTimer.measure('deletePage', markdownFile):
+                if self.args.recursive:
+                    self.confluenceAdapter.deletePageTree(targetPageInfo, convertedPage.title, self.args.workers)
+                else:
+                    self.confluenceAdapter.deletePage(targetPageInfo, convertedPage.title)
+        else:
+            if ancestorSnippet is None:
+                with self.phaseTimer.measure('getAncestorsSnippet', markdownFile):
+                    ancestorSnippet = self.getAncestorsSnippet()
+
+            with self.phaseTimer.measure('uploadPage', markdownFile):
+                pageId = self.confluenceAdapter.uploadPage(
+                    targetPageInfo,
+                    convertedPage.title,
+                    convertedPage.storage,
+                    ancestorSnippet,
+                )
+
+            with self.phaseTimer.measure('uploadAttachments', markdownFile):
+                self.confluenceAdapter.uploadAttachments(
+                    sourceFolder,
+                    pageId,
+                    convertedPage.normalized2OriginalSrcMapping)
+            return pageId
 
     def getAncestorsSnippet(self):
+        with self.ancestorLock:
+            if self.ancestorSnippet is None:
+                self.ancestorSnippet = self.resolveAncestorsSnippet()
+            return self.ancestorSnippet
+
+    def resolveAncestorsSnippet(self):
         if self.args.ancestor:
-            parentPageInfo = self.confluenceAdapter.getPageInfo(
-                self.args.ancestor, 'parent')
-            if parentPageInfo:
-                return [
-                    {'type': 'page', 'id': parentPageInfo.id}
-                ]
-            else:
-                raise Exception(
-                    'The parent page "{}" does not exist.'.format(self.args.ancestor))
+            parentPageInfo = self.getPageInfo(self.args.ancestor, 'parent')
+            return self.createAncestorsSnippet(parentPageInfo)
         else:
             return []
 
-    def printWelcomeMessage(self):
+    def createSectionAncestorsSnippet(self, pageId):
+        # when deleting, there is no page id and no ancestor is needed
+        return [{'type': 'page', 'id': pageId}] if pageId else []
+
+    def createAncestorsSnippet(self, parentPageInfo):
+        if parentPageInfo:
+            return [
+                {'type': 'page', 'id': parentPageInfo.id}
+            ]
+        else:
+            raise Exception(
+                'The parent page "{}" does not exist.'.format(self.args.ancestor))
+
+    def printWelcomeMessage(self, markdownFile, title):
         print('''------------------------
 Markdown Confluence Sync
 ------------------------
@@ -84,9 +481,9 @@ Markdown file: "{}"
 Space key:     "{}"
 Title:         "{}"
 Parent title:  "{}"
-'''.format(os.path.abspath(self.args.markdownFile),
+'''.format(os.path.abspath(markdownFile),
            self.args.spacekey,
-           self.title,
+           title,
            # TODO: what will be used?
            self.args.ancestor or '(nothing provided, will create the page directly in the root of the selected space)'
            )
@@ -0,0 +1,65 @@
+'''
+Finding the markdown files to sync.
+'''
+
+import glob
+import os.path
+import subprocess
+
+
+MARKDOWN_SUFFIXES = ('.md', '.markdown')
+
+
+def collectMarkdownFiles(paths):
+    ''' expands the given paths into a sorted list of markdown files
+        (paths may be files, directories which are searched recursively or glob patterns)
+    '''
+    markdownFiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, filenames in os.walk(path):
+                markdownFiles.extend(
+                    os.path.join(folder, filename)
+                    for filename in filenames
+                    if filename.lower().endswith(MARKDOWN_SUFFIXES))
+        elif os.path.exists(path):
+            markdownFiles.append(path)
+        else:
+            matches = glob.glob(path, recursive=True)
+            if not matches:
+                raise Exception(
+                    'Markdown file: "{}" does not exist.'.format(os.path.abspath(path)))
+            markdownFiles.extend(match for match in matches if os.path.isfile(match))
+
+    # the same file may be matched by several paths
+    uniqueMarkdownFiles = {os.path.abspath(f): f for f in markdownFiles}
+    return [uniqueMarkdownFiles[f] for f in sorted(uniqueMarkdownFiles)]
+
+
+def getFilesChangedSince(revision, paths):
+    ''' returns the absolute paths of the files that differ from the given git revision,
+        including uncommitted changes and new files, in the repositories of the given paths
+    '''
+    changedFiles = set()
+    topLevels = set()
+    for folder in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+        topLevels.add(runGit(folder, 'rev-parse', '--show-toplevel').strip())
+
+    for topLevel in topLevels:
+        output = runGit(topLevel, 'diff', '--name-only', '-z', revision, '--') + \
+            runGit(topLevel, 'ls-files', '-z', '--others', '--exclude-standard')
+        changedFiles.update(
+            os.path.normpath(os.path.join(topLevel, path)) for path in output.split('\0') if path)
+    return changedFiles
+
+
+def runGit(folder, *arguments):
+    completedProcess = subprocess.run(
+        ['git', '-C', folder] + list(arguments),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if completedProcess.returncode != 0:
+        raise Exception('"git {}" failed in "{}": {}'.format(
+            ' '.join(arguments), folder, completedProcess.stderr.strip()))
+    return completedProcess.stdout
@@ -4,14 +4,17 @@ Created on Feb 1, 2017
 @author: tobias-vogel-seerene
 '''
 
+import functools
 import os
-import re
+import time
 
-from bs4 import BeautifulSoup, CData
 import markdown
-from pip._vendor.pyparsing import line
 
 
+# increase whenever a change of either converter changes the converted pages, so
+# that no cached conversions are used anymore
+CONVERTER_VERSION = 3
+
 MD_EXTENSIONS = [
     'markdown.extensions.tables',
     'markdown.extensions.fenced_code',
@@ -29,34 +32,80 @@ TOC_PARAMS = {
 }
 
 
+# BeautifulSoup is only imported when this converter is used, the native converter
+# (which inherits from it) does not need it
+@functools.lru_cache(maxsize=None)
+def getStorageFormat():
+    ''' the storage format is XHTML: only &, < and > are escaped and empty elements
+        are closed like <br />
+    '''
+    from bs4.dammit import EntitySubstitution
+    from bs4.formatter import HTMLFormatter
+    return HTMLFormatter(
+        entity_substitution=EntitySubstitution.substitute_xml,
+        void_element_close_prefix=' /')
+
+
 class MarkdownHtmlConverter(object):
 
-    def __init__(self, markdownfilename):
+    def __init__(self, markdownfilename, markdowntext=None):
+        ''' markdowntext is converted instead of the content of the file if given,
+            e.g., a section of it
+        '''
         self.markdownfilename = markdownfilename
-        html = self.convertMarkdownToHtml()
-        self.soup = BeautifulSoup(html, "html.parser")
-        self.finetuneSoup()
+        self.markdowntext = markdowntext
+        # phase -> seconds spent in it
+        self.phases = {}
+        from bs4 import BeautifulSoup
+        html = self.timePhase('convertMarkdownToHtml', self.convertMarkdownToHtml)
+        self.soup = self.timePhase('parseHtml', BeautifulSoup, html, "html.parser")
         self.normalized2OriginalSrcMapping = {}
-        self.replaceIncludesOfLocalResources()
+        self.titleElement = None
+
+        # tag name -> function that rewrites such an element in place
+        self.rewriteHandlers = {}
+        self.registerRewriteHandler('h1', self.rememberTitle)
+        self.registerRewriteHandler('pre', self.replaceCodeBlock)
+        self.registerRewriteHandler('img', self.replaceIncludeOfLocalImage)
+        self.registerRewriteHandler('a', self.replaceIncludeOfLocalAttachment)
+
+        self.timePhase('finetuneSoup', self.finetuneSoup)
+
+    def timePhase(self, phase, function, *args):
+        ''' calls function(*args) and adds the time it took to the phase '''
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start
 
     def convertMarkdownToHtml(self):
+        mdtext = self.readMarkdown()
+        html = markdown.markdown(mdtext, extensions=MD_EXTENSIONS)
+        return html
+
+    def readMarkdown(self):
+        if self.markdowntext is not None:
+            return self.markdowntext
         with open(self.markdownfilename, 'r') as inp:
-            mdtext = inp.read()
-            html = markdown.markdown(mdtext, extensions=MD_EXTENSIONS)
-            return html
+            return inp.read()
 
     def getTitle(self):
-        try:
-            return self.soup.find('h1').extract().text
-        except:
+        if self.titleElement is None:
             return os.path.splitext(os.path.basename(self.markdownfilename))[0]
+        return self.titleElement.extract().text
+
+    def rememberTitle(self, h1):
+        # the first <h1> is the title
+        if self.titleElement is None:
+            self.titleElement = h1
 
     def cautiouslyAddMapping(self, normalizedPath, originalPath):
         existingOriginalPath = self.normalized2OriginalSrcMapping.get(
             normalizedPath)
         if existingOriginalPath == None:
             self.normalized2OriginalSrcMapping[normalizedPath] = originalPath
-        elif existingOriginalPath != normalizedPath:
+        elif existingOriginalPath != originalPath:
             raise Exception('There is a conflict with normalized file paths. "{}" and "{}" both are renamed to "{}"'.format(
                 originalPath, existingOriginalPath, normalizedPath))
 
@@ -72,28 +121,38 @@ class MarkdownHtmlConverter(object):
 
         self.soup.insert(0, toc)
 
-    def replaceIncludesOfLocalResources(self):
-        # first, replace local images references
-        self.replaceIncludesOfLocalImages()
+    def addChildIndex(self, childTitles):
+        ''' appends a list of links to the given pages, that is how an entry should look like:
+            <li><ac:link><ri:page ri:content-title="Page - Section" /><ac:plain-text-link-body><![CDATA[Section]]></ac:plain-text-link-body></ac:link></li>
 
-        # second, replace references to other local resources (pdf, json, zip,
-        # etc.) that may be decorated with an image (thus, the images have been
-        # converted before)
-        self.replaceIncludesOfLocalAttachments()
-
-    def replaceIncludesOfLocalImages(self):
-        for img in self.soup.findAll('img'):
-            src = img['src']
-            if self.isLocalReference(src):
-                normalizedSrc = self.normalizePath(src)
-                self.cautiouslyAddMapping(normalizedSrc, src)
-                img['src'] = normalizedSrc
-                self.transformImgToConfluenceImageInclude(img)
+            childTitles maps the page titles to the link texts
+        '''
+        from bs4 import CData
+        index = self.soup.new_tag('ul')
+        for childTitle, linkText in childTitles.items():
+            pageElement = self.soup.new_tag('ri:page', **{'ri:content-title': childTitle})
+            pageElement.can_be_empty_element = True
+            linkBodyElement = self.soup.new_tag('ac:plain-text-link-body')
+            linkBodyElement.append(CData(linkText))
+            linkElement = self.soup.new_tag('ac:link')
+            linkElement.append(pageElement)
+            linkElement.append(linkBodyElement)
+            itemElement = self.soup.new_tag('li')
+            itemElement.append(linkElement)
+            index.append(itemElement)
+        self.soup.append(index)
+
+    def replaceIncludeOfLocalImage(self, img):
+        src = img['src']
+        if self.isLocalReference(src):
+            normalizedSrc = self.normalizePath(src)
+            self.cautiouslyAddMapping(normalizedSrc, src)
+            img['src'] = normalizedSrc
+            self.transformImgToConfluenceImageInclude(img)
 
     def transformImgToConfluenceImageInclude(self, img):
         ''' that is how it should look like:
             <ac:image ac:title="titletext" ac:alt="alttext" ac:height="250"><ri:attachment ri:filename="bla.jpg" /></ac:image></p>
-            (actually beautiful soup does not create a self-closing ri:attachment tag, but a regular one, but it still works
             '''
         attributes = {}
         if 'alt' in img.attrs.keys():
@@ -101,38 +160,51 @@ class MarkdownHtmlConverter(object):
         if 'title' in img.attrs.keys():
             attributes['ac:title'] = img['title']
 
-        imageElement = self.soup.new_tag('ac:image', **attributes)
-        # imageElement.string = '<ri:attachment ri:filename="{}" />'.format(
-        #    img['src'])
-        # beautifulsoup cannot create self-closing tags (unless the allowed
-        # elements are configured properly, so we do it by hand)
-        attachmentElement = self.soup.new_tag(
-            'ri:attachment', **{'ri:filename': img['src']})
-        imageElement.append(attachmentElement)
-        img.replaceWith(imageElement)
-
-    def replaceIncludesOfLocalAttachments(self):
-        for a in self.soup.findAll('a'):
-            href = a['href']
-            if self.isLocalReference(href):
-                normalizedHref = self.normalizePath(href)
-                self.cautiouslyAddMapping(normalizedHref, href)
-                a['href'] = normalizedHref
-                self.transformAToConfluenceAttachmentInclude(a)
+        attachmentElement = self.createAttachmentElement(img['src'])
+        self.transformElement(img, 'ac:image', attributes)
+        img.append(attachmentElement)
+
+    def replaceIncludeOfLocalAttachment(self, a):
+        # references to other local resources (pdf, json, zip, etc.) may be
+        # decorated with an image, which is moved into the link body as it is
+        # and rewritten when the traversal reaches it
+        href = a['href']
+        if self.isLocalReference(href):
+            normalizedHref = self.normalizePath(href)
+            self.cautiouslyAddMapping(normalizedHref, href)
+            a['href'] = normalizedHref
+            self.transformAToConfluenceAttachmentInclude(a)
 
     def transformAToConfluenceAttachmentInclude(self, a):
         ''' that is how it should look like:
             <ac:link><ri:attachment ri:filename="somefile.dat" /><ac:link-body>whatever was inside the original <a> tag</ac:link-body></ac:link>
-            (actually beautiful soup does not create a self-closing ri:attachment tag, but a regular one, but it still works
             '''
-        anchorElement = self.soup.new_tag('ac:link')
-        attachmentElement = self.soup.new_tag(
-            'ri:attachment', **{'ri:filename': a['href']})
+        attachmentElement = self.createAttachmentElement(a['href'])
         linkBodyElement = self.soup.new_tag('ac:link-body')
-        linkBodyElement.contents = a.contents
-        anchorElement.append(attachmentElement)
-        anchorElement.append(linkBodyElement)
-        a.replaceWith(anchorElement)
+        for child in list(a.contents):
+            linkBodyElement.append(child)
+        self.transformElement(a, 'ac:link', {})
+        a.append(attachmentElement)
+        a.append(linkBodyElement)
+
+    def createAttachmentElement(self, filename):
+        attachmentElement = self.soup.new_tag(
+            'ri:attachment', **{'ri:filename': filename})
+        # written as a self-closing tag
+        attachmentElement.can_be_empty_element = True
+        return attachmentElement
+
+    def transformElement(self, element, name, attributes):
+        ''' turns the element into another one in place
+
+            Replacing it would be simpler, but beautiful soup looks up the position of a
+            replaced element among all its siblings, which makes documents with many code
+            blocks or images quadratic to convert.
+        '''
+        element.name = name
+        element.attrs = attributes
+        # an <img> is a void element, the new one is not
+        element.can_be_empty_element = False
 
     def isLocalReference(self, srcAttribute):
         return not srcAttribute.startswith('http')
@@ -144,11 +216,27 @@ class MarkdownHtmlConverter(object):
     def getNormalized2OriginalSrcMapping(self):
         return self.normalized2OriginalSrcMapping
 
+    def registerRewriteHandler(self, tagName, handler):
+        ''' makes the traversal call handler(element) for every element with the given
+            tag name, replacing a handler registered before
+        '''
+        self.rewriteHandlers[tagName] = handler
+
     def finetuneSoup(self):
-        self.replaceCodeBlocks()
+        self.rewriteSoup()
         self.replaceUnorderedLists()
 
-    def replaceCodeBlocks(self):
+    def rewriteSoup(self):
+        ''' walks the soup only once, no matter how many rewrites there are
+
+            The elements of interest are collected in document order first, as the
+            handlers change the tree. An element that is moved by a handler (like the
+            contents of a link) is still rewritten at its new place.
+        '''
+        for element in self.soup.find_all(list(self.rewriteHandlers)):
+            self.rewriteHandlers[element.name](element)
+
+    def replaceCodeBlock(self, codeblock):
         ''' this is how it should look like:
         <ac:structured-macro ac:name="code" ac:schema-version="1" ac:macro-id="168f7514-4b7f-4202-9832-76ca4d2f9650">
             <ac:plain-text-body>
@@ -160,37 +248,26 @@ third line]]>
 
         code blocks are initially created as <pre><code>code...</code></pre>
         '''
-        for codeblock in self.soup.findAll('pre'):
-            children = codeblock.findChildren()
-            if len(children) == 1:
-                firstChild = children[0]
-                if firstChild.name == 'code':
-                    codeText = firstChild.text
-                    structuredMacroElement = self.soup.new_tag(
-                        'ac:structured-macro', **{'ac:name': 'code', 'ac:schema-version': 1})
-                    plainTextBodyElement = self.soup.new_tag(
-                        'ac:plain-text-body')
-                    cdata = CData(codeText)
-                    plainTextBodyElement.append(cdata)
-                    structuredMacroElement.append(plainTextBodyElement)
-                    codeblock.replaceWith(structuredMacroElement)
+        # two are enough to tell whether <code> is the only descendant
+        children = codeblock.find_all(True, limit=2)
+        if len(children) == 1:
+            firstChild = children[0]
+            if firstChild.name == 'code':
+                codeText = firstChild.text
+                plainTextBodyElement = self.soup.new_tag(
+                    'ac:plain-text-body')
+                from bs4 import CData
+                cdata = CData(codeText)
+                plainTextBodyElement.append(cdata)
+                codeblock.clear()
+                self.transformElement(
+                    codeblock, 'ac:structured-macro', {'ac:name': 'code', 'ac:schema-version': 1})
+                codeblock.append(plainTextBodyElement)
 
     def replaceUnorderedLists(self):
         # TODO remove this method if it contains no meaningful content
         pass
 
     def prettyPrint(self):
-        html = self.soup.prettify()
-        html = self.polishHtml(html)
-        return html
-
-    def polishHtml(self, html):
-        # do last changes that cannot be done with BeautifulSoup
-
-        html = self.selfCloseRiAttachments(html)
-        return html
-
-    def selfCloseRiAttachments(self, html):
-        # simulate self-closing <ri:attachment> tags
-        html = re.sub(r'">\s*</ri:attachment>', r'" />', html, re.M)
-        return html
+        # not indented, which would only inflate the page, and written in one pass
+        return self.soup.decode(formatter=getStorageFormat())
@@ -0,0 +1,43 @@
+'''
+Splits a markdown document into sections at the headings of a given level.
+'''
+
+import re
+
+
+# code blocks may contain lines that look like headings
+FENCE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+
+LINK_DEFINITION = re.compile(r'^ {0,3}\[[^\]]+\]:\s*\S')
+
+
+def splitMarkdown(text, level):
+    ''' returns the text before the first heading of the given level and a list with
+        the text of each section, in which that heading has been turned into an <h1>,
+        i.e., into the title of the section
+
+        Only ATX headings ("## Section") are split at. Link definitions are copied
+        into every part, as they may be used anywhere in the document.
+    '''
+    heading = re.compile(r'^( {0,3})#{%d}(?=\s|$)' % level)
+
+    parts = [[]]
+    linkDefinitions = []
+    fence = None
+    for line in text.splitlines(keepends=True):
+        fenceMatch = FENCE.match(line)
+        if fence is not None:
+            if fenceMatch and fenceMatch.group(1)[0] == fence[0] and len(fenceMatch.group(1)) >= len(fence):
+                fence = None
+        elif fenceMatch:
+            fence = fenceMatch.group(1)
+        elif heading.match(line):
+            parts.append([])
+            line = heading.sub(r'\1#', line, count=1)
+        elif LINK_DEFINITION.match(line):
+            linkDefinitions.append(line if line.endswith('\n') else line + '\n')
+        parts[-1].append(line)
+
+    linkDefinitions = ''.join(linkDefinitions)
+    parts = [''.join(part) + ('\n' + linkDefinitions if linkDefinitions else '') for part in parts]
+    return parts[0], parts[1:]
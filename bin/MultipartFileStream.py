@@ -0,0 +1,59 @@
+'''
+A multipart/form-data body that streams a file from disk instead of building the
+whole body in memory (as requests does for its files= parameter).
+'''
+
+import os.path
+import uuid
+
+
+# the file is sent in chunks of this size, which bounds the memory used per upload
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartFileStream(object):
+    ''' requests sends iterables as the request body and, as the length is known,
+        sets the Content-Length header instead of using chunked transfer encoding.
+        Each iteration opens the file anew, so the body can be sent again on a retry.
+    '''
+
+    def __init__(self, fields, fileFieldName, filename, path, contentType, fileHeaders=None):
+        self.path = path
+        self.boundary = uuid.uuid4().hex
+
+        head = b''
+        for name, value in fields.items():
+            head += self.encodePartHeader(
+                'form-data; name="{}"'.format(self.quote(name)), {})
+            head += value.encode('utf-8') + b'\r\n'
+
+        headers = {'Content-Type': contentType}
+        headers.update(fileHeaders or {})
+        head += self.encodePartHeader(
+            'form-data; name="{}"; filename="{}"'.format(self.quote(fileFieldName), self.quote(filename)),
+            headers)
+
+        self.head = head
+        self.tail = '\r\n--{}--\r\n'.format(self.boundary).encode('ascii')
+        self.fileSize = os.path.getsize(path)
+
+    def encodePartHeader(self, contentDisposition, headers):
+        lines = ['--{}'.format(self.boundary), 'Content-Disposition: ' + contentDisposition]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+    def quote(self, value):
+        return value.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+    def getContentType(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return len(self.head) + self.fileSize + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                yield chunk
+        yield self.tail
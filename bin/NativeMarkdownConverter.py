@@ -0,0 +1,61 @@
+'''
+Converts markdown to the Confluence storage format in a single markdown run, without
+parsing the rendered HTML again.
+'''
+
+import html
+import os
+
+import markdown
+
+from ConfluenceStorageExtension import ConfluenceStorageExtension, createCData
+from MarkdownHtmlConverter import MarkdownHtmlConverter, MD_EXTENSIONS, TOC_PARAMS
+
+
+class NativeMarkdownConverter(MarkdownHtmlConverter):
+    ''' offers the same interface as the MarkdownHtmlConverter
+
+        Unlike there, HTML that is written directly into the markdown file is passed
+        through as it is, i.e., images and links in it are not rewritten.
+    '''
+
+    def __init__(self, markdownfilename, markdowntext=None):
+        self.markdownfilename = markdownfilename
+        self.markdowntext = markdowntext
+        self.normalized2OriginalSrcMapping = {}
+        self.contents = ''
+        self.childIndex = ''
+        self.extension = ConfluenceStorageExtension(self.resolveReference)
+        self.phases = {}
+        self.html = self.timePhase('convertMarkdownToStorageFormat', self.convertMarkdownToStorageFormat)
+
+    def convertMarkdownToStorageFormat(self):
+        mdtext = self.readMarkdown()
+        return markdown.markdown(mdtext, extensions=MD_EXTENSIONS + [self.extension])
+
+    def resolveReference(self, reference):
+        if not self.isLocalReference(reference):
+            return None
+        normalizedReference = self.normalizePath(reference)
+        self.cautiouslyAddMapping(normalizedReference, reference)
+        return normalizedReference
+
+    def getTitle(self):
+        # the first <h1> has been removed from the document already
+        if self.extension.title is None:
+            return os.path.splitext(os.path.basename(self.markdownfilename))[0]
+        return self.extension.title
+
+    def addContents(self):
+        self.contents = '<ac:structured-macro ac:name="toc">{}</ac:structured-macro>'.format(''.join(
+            '<ac:parameter ac:name="{}">{}</ac:parameter>'.format(key, html.escape(val))
+            for key, val in TOC_PARAMS.items()))
+
+    def addChildIndex(self, childTitles):
+        self.childIndex = '<ul>{}</ul>'.format(''.join(
+            '<li><ac:link><ri:page ri:content-title="{}" /><ac:plain-text-link-body>{}</ac:plain-text-link-body></ac:link></li>'.format(
+                html.escape(childTitle), createCData(linkText))
+            for childTitle, linkText in childTitles.items()))
+
+    def prettyPrint(self):
+        return self.contents + self.html + self.childIndex
@@ -5,4 +5,10 @@ Created on Feb 2, 2017
 '''
 import collections
 
-PageInfo = collections.namedtuple('PageInfo', ['id', 'version', 'link'])
\ No newline at end of file
+# digest is the digest of the content that md2conf uploaded the last time (None if
+# the page has been changed by someone else since then), digestPropertyVersion is
+# the version of the content property the digest is stored in
+PageInfo = collections.namedtuple(
+    'PageInfo',
+    ['id', 'version', 'link', 'digest', 'digestPropertyVersion'],
+    defaults=[None, None])
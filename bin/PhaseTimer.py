@@ -0,0 +1,61 @@
+'''
+Measures how long the phases of a sync take, per markdown file, and writes them as a
+JSON report.
+'''
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        # phases that concern the whole run, e.g. resolving all titles at once
+        self.runPhases = collections.Counter()
+        # markdown file -> phase of the sync -> seconds
+        self.documentPhases = collections.defaultdict(collections.Counter)
+        # markdown file -> phase of the conversion -> seconds
+        self.conversionPhases = collections.defaultdict(collections.Counter)
+
+    @contextlib.contextmanager
+    def measure(self, phase, markdownFile=None):
+        ''' measures the time spent in the with block, which adds up if it is measured several times '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                if markdownFile is None:
+                    self.runPhases[phase] += seconds
+                else:
+                    self.documentPhases[markdownFile][phase] += seconds
+
+    def addConversionPhases(self, markdownFile, phases):
+        # the conversion may have taken place in another process, which measured it
+        with self.lock:
+            self.conversionPhases[markdownFile].update(phases)
+
+    def getReport(self):
+        with self.lock:
+            return {
+                'seconds': time.perf_counter() - self.start,
+                'phases': dict(self.runPhases),
+                'documents': {
+                    markdownFile: {
+                        'phases': dict(self.documentPhases[markdownFile]),
+                        'conversion': dict(self.conversionPhases.get(markdownFile, {})),
+                    }
+                    for markdownFile in self.documentPhases
+                },
+            }
+
+    def writeReport(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.getReport(), out, indent=2)
+        print('The timing report has been written to "{}".'.format(path))
@@ -0,0 +1,33 @@
+'''
+A token bucket that limits the rate of requests across all workers.
+'''
+
+import threading
+import time
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst=None):
+        ''' rate is the number of requests per second, burst the number of requests
+            that may be issued at once after a quiet period (defaults to one second's worth)
+        '''
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ''' blocks until a request may be issued and returns the seconds waited '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is reserved right away, so waiting does not need the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,123 @@
+'''
+A local SQLite index of the pages of a space, so that titles can be resolved without
+asking Confluence every time.
+'''
+
+import datetime
+import sqlite3
+import threading
+
+from PageInfo import PageInfo
+
+
+# pages modified this long before the last refresh are fetched again, which covers
+# clock and timezone differences between this machine and Confluence
+REFRESH_OVERLAP = datetime.timedelta(days=1)
+
+# increased whenever the schema changes, an index with another schema is built anew
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    spacekey TEXT NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    link TEXT NOT NULL,
+    digest TEXT,
+    digestPropertyVersion INTEGER,
+    lastModified TEXT,
+    PRIMARY KEY (spacekey, id)
+);
+CREATE INDEX IF NOT EXISTS pagesByTitle ON pages (spacekey, title);
+CREATE TABLE IF NOT EXISTS refreshes (
+    spacekey TEXT PRIMARY KEY,
+    lastModified TEXT NOT NULL
+);
+'''
+
+
+class SpaceIndex(object):
+
+    def __init__(self, path, spacekey):
+        self.path = path
+        self.spacekey = spacekey
+        # the index is shared by all workers
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                self.connection.executescript('DROP TABLE IF EXISTS pages; DROP TABLE IF EXISTS refreshes;')
+                self.connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self.connection.executescript(SCHEMA)
+
+    def refresh(self, confluenceAdapter):
+        ''' fills the index with one paginated listing of the space the first time,
+            afterwards only pages modified since the last refresh are fetched
+        '''
+        lastModified = self.getLastModified()
+        if lastModified is None:
+            print('Building the space index "{}" for space "{}"… '.format(self.path, self.spacekey),
+                  end='',
+                  flush=True)
+            results = confluenceAdapter.listPages()
+            replaceAll = True
+        else:
+            since = datetime.datetime.strptime(lastModified[:16], '%Y-%m-%dT%H:%M') - REFRESH_OVERLAP
+            print('Refreshing the space index "{}" with pages modified since {}… '.format(
+                self.path, since.strftime('%Y-%m-%d %H:%M')),
+                end='',
+                flush=True)
+            results = confluenceAdapter.listPagesModifiedSince(since)
+            replaceAll = False
+
+        entries = [(confluenceAdapter.createPageInfo(result), result) for result in results]
+
+        with self.lock, self.connection:
+            if replaceAll:
+                self.connection.execute('DELETE FROM pages WHERE spacekey = ?', (self.spacekey,))
+            for pageInfo, result in entries:
+                self.putEntry(result['title'], pageInfo, result['version'].get('when'))
+
+            newestModification = max(
+                [lastModified or ''] + [result['version'].get('when') or '' for _, result in entries])
+            if newestModification:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO refreshes (spacekey, lastModified) VALUES (?, ?)',
+                    (self.spacekey, newestModification))
+
+        print('OK, {} pages.'.format(len(entries)))
+
+    def getLastModified(self):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT lastModified FROM refreshes WHERE spacekey = ?', (self.spacekey,)).fetchone()
+        return row[0] if row else None
+
+    def getPageInfo(self, title):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, version, link, digest, digestPropertyVersion FROM pages WHERE spacekey = ? AND title = ?',
+                (self.spacekey, title)).fetchall()
+        # several entries mean that some of them are stale (a deleted page has been
+        # recreated), so the title has to be looked up again
+        return PageInfo(*rows[0]) if len(rows) == 1 else None
+
+    def put(self, title, pageInfo):
+        with self.lock, self.connection:
+            self.putEntry(title, pageInfo, None)
+
+    def putEntry(self, title, pageInfo, lastModified):
+        # a page may have been renamed, so entries are identified by id
+        self.connection.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.spacekey, pageInfo.id, title, pageInfo.version, pageInfo.link,
+             pageInfo.digest, pageInfo.digestPropertyVersion, lastModified))
+
+    def forget(self, title):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM pages WHERE spacekey = ? AND title = ?', (self.spacekey, title))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,121 @@
+'''
+A local record of what has been synced, so that unchanged markdown files are not even
+read again.
+'''
+
+import hashlib
+import json
+import os
+import os.path
+import threading
+
+from AtomicFile import writeAtomically
+from ContentDigest import digestFile
+
+
+MANIFEST_VERSION = 1
+
+
+class SyncManifest(object):
+    ''' remembers, for each markdown file synced successfully, the modification time,
+        size and digest of the file and of its attachments, and the ids and versions of
+        its pages
+
+        A file has changed if the size of it or of one of its attachments differs, or
+        if the modification time differs and so does the digest. The manifest is only
+        valid for the settings it has been written with (the space, the parent page,
+        the conversion options), a manifest written with others is ignored. Changes
+        made in Confluence are not noticed.
+    '''
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.folder = os.path.dirname(os.path.abspath(path))
+        self.settingsKey = hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as inp:
+                data = json.load(inp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print('The sync manifest "{}" cannot be read ({}), all files are synced.'.format(self.path, e))
+            return {}
+
+        if data.get('version') != MANIFEST_VERSION or data.get('settings') != self.settingsKey:
+            print('The sync manifest "{}" has been written with other settings, all files are synced.'.format(
+                self.path))
+            return {}
+        return data['files']
+
+    def getKey(self, markdownFile):
+        # relative paths keep the manifest valid if the whole tree is moved
+        return os.path.relpath(os.path.abspath(markdownFile), self.folder)
+
+    def getAttachmentPaths(self, markdownFile):
+        ''' returns the absolute paths of the attachments recorded for the markdown file '''
+        with self.lock:
+            entry = self.entries.get(self.getKey(markdownFile))
+        if entry is None:
+            return []
+        sourceFolder = os.path.dirname(os.path.abspath(markdownFile))
+        return [os.path.normpath(os.path.join(sourceFolder, path)) for path in entry['attachments']]
+
+    def hasChanged(self, markdownFile):
+        with self.lock:
+            entry = self.entries.get(self.getKey(markdownFile))
+        if entry is None:
+            return True
+
+        sourceFolder = os.path.dirname(os.path.abspath(markdownFile))
+        if not self.isUnchanged(os.path.abspath(markdownFile), entry['markdown']):
+            return True
+        return not all(self.isUnchanged(os.path.join(sourceFolder, path), fileState)
+                       for path, fileState in entry['attachments'].items())
+
+    def isUnchanged(self, path, fileState):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != fileState['size']:
+            return False
+        if stat.st_mtime_ns == fileState['mtime']:
+            return True
+        # touched, but maybe not changed
+        if digestFile(path) != fileState['digest']:
+            return False
+        with self.lock:
+            fileState['mtime'] = stat.st_mtime_ns
+        return True
+
+    def captureFileState(self, path):
+        ''' returns the state of the file to be recorded once it has been synced, it is
+            taken before the sync, so that changes during the sync are noticed next time
+        '''
+        stat = os.stat(path)
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'digest': digestFile(path)}
+
+    def record(self, markdownFile, markdownState, attachmentStates, pages):
+        ''' attachmentStates maps the paths relative to the markdown file to their state,
+            pages is a list of (title, id, version) of the page and its sections
+        '''
+        with self.lock:
+            self.entries[self.getKey(markdownFile)] = {
+                'markdown': markdownState,
+                'attachments': attachmentStates,
+                'pages': [{'title': title, 'id': pageId, 'version': version} for title, pageId, version in pages],
+            }
+
+    def forget(self, markdownFile):
+        with self.lock:
+            self.entries.pop(self.getKey(markdownFile), None)
+
+    def save(self):
+        with self.lock:
+            data = {'version': MANIFEST_VERSION, 'settings': self.settingsKey, 'files': dict(self.entries)}
+        # an interrupted run must not leave a damaged manifest behind
+        writeAtomically(self.path, json.dumps(data, indent=1, sort_keys=True))
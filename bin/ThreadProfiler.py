@@ -0,0 +1,43 @@
+'''
+Profiles the current thread and all threads started afterwards with cProfile, as the
+work of a sync is done in worker threads.
+'''
+
+import cProfile
+import pstats
+import sys
+import threading
+
+
+class ThreadProfiler(object):
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        if sys.version_info >= (3, 12):
+            # cProfile uses sys.monitoring, which covers all threads, and only one
+            # profiler may be active at a time
+            self.mainProfile = self.profileThread()
+            return
+        # new threads call profileThread when they start running, which installs
+        # a profiler of their own
+        threading.setprofile(self.profileThread)
+        self.mainProfile = self.profileThread()
+
+    def profileThread(self, *args):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def stop(self, path):
+        ''' writes the statistics of all threads to path '''
+        threading.setprofile(None)
+        self.mainProfile.disable()
+        with self.lock:
+            profiles = list(self.profiles)
+        pstats.Stats(*profiles).dump_stats(path)
+        print('The profile of all threads has been written to "{}".'.format(path))
@@ -9,7 +9,14 @@ from os import getenv
 import os.path
 import sys
 
-from MarkdownConfluenceSync import MarkdownConfluenceSync
+from MarkdownFiles import MARKDOWN_SUFFIXES, collectMarkdownFiles
+
+
+def looksLikeSpaceKey(argument):
+    # neither an existing file, nor a path, nor a glob pattern
+    return not os.path.exists(argument) \
+        and not any(c in argument for c in '/*?[' + os.sep) \
+        and not argument.lower().endswith(MARKDOWN_SUFFIXES)
 
 
 if __name__ == "__main__":
@@ -18,14 +25,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        "markdownFile",
-        help="Full path of the markdown file to convert and upload. If the page already exists, it will be overwritten."
+        "markdownFiles",
+        nargs='+',
+        metavar='markdownFile',
+        help="Full path of the markdown file to convert and upload. If the page already exists, it will be overwritten. Several files, directories (searched recursively for *.md files) or glob patterns may be given to sync them all in one run. The Confluence Space key for the page may follow the markdown files if it is not an existing file, contains no path separator and does not end in .md or .markdown, use -s otherwise. If omitted, will use user space."
     )
     parser.add_argument(
-        'spacekey',
-        nargs='?',
+        '-s',
+        '--spacekey',
         default='',
-        help="Confluence Space key for the page. If omitted, will use user space."
+        help='Confluence Space key for the page, instead of giving it after the markdown files. If omitted, will use user space.'
     )
     parser.add_argument(
         '-u',
@@ -62,6 +71,32 @@ if __name__ == "__main__":
         default=False,
         help='Use this option to generate a contents page. (Currently, it does not work and you should not use this parameter.'
     )
+    parser.add_argument(
+        '--converter',
+        choices=['beautifulsoup', 'native'],
+        default='beautifulsoup',
+        help='How markdown is converted into the Confluence storage format: "beautifulsoup" renders HTML and rewrites it, "native" emits the storage format directly, which is faster and needs less memory, but does not upload images and links in HTML written into the markdown files as attachments. (Default: beautifulsoup)'
+    )
+    parser.add_argument(
+        '--split-level',
+        type=int,
+        help='Split each markdown file at the headings of this level (e.g., 2 for "## Section"). The sections are published as child pages titled "<title> - <section>" and the page links to them. Sections that have not changed are not sent again.'
+    )
+    parser.add_argument(
+        '--conversion-workers',
+        type=int,
+        help='Number of processes that convert markdown files concurrently. 1 converts them in the workers syncing them. (Default: the number of CPU cores)'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory to cache converted markdown files in. Files that have not changed since they have been converted the last time are not converted again.'
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=256,
+        help='Maximum size of the conversion cache in MB. The least recently used entries are removed beyond that. (Default: 256)'
+    )
     parser.add_argument(
         '-n',
         '--nossl',
@@ -76,19 +111,136 @@ if __name__ == "__main__":
         default=False,
         help='Use this option to delete the page instead of creating/updating it. The markdown file is then used only to find out the name of the page to be deleted.'
     )
+    parser.add_argument(
+        '-r',
+        '--recursive',
+        action='store_true',
+        default=False,
+        help='Use this option together with -d to delete all pages below the page as well. The pages are deleted from the bottom up, --workers of them at once; pages with descendants that could not be deleted are kept.'
+    )
     parser.add_argument(
         '--force-wiki-url',
         default=getenv('CONFLUENCE_WIKI_URL', None),
         help='Use this option to force other than http(s)://<orgname>.atlassian.net/wiki url. Would disable <orgname> and <nossl> options. Also available as $CONFLUENCE_WIKI_URL env.'
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of markdown files that are synced concurrently when several files are given. (Default: 4)'
+    )
+    parser.add_argument(
+        '--attachment-workers',
+        type=int,
+        default=4,
+        help='Number of attachments of a page that are uploaded concurrently. (Default: 4)'
+    )
+    parser.add_argument(
+        '--space-index',
+        help='Path of a local SQLite file that indexes the pages of the space. It is built with one listing of the space, refreshed with the pages modified since the last run and then used instead of looking up every title.'
+    )
+    parser.add_argument(
+        '--rate-limit',
+        type=float,
+        help='Maximum number of requests per second, shared by all workers. (Default: unlimited)'
+    )
+    parser.add_argument(
+        '--max-retries',
+        type=int,
+        default=5,
+        help='How often a request is retried when Confluence is throttling (429) or temporarily unavailable (503, and 502 or 504 for requests that may be sent twice, i.e., not POST). The Retry-After header is honoured, otherwise the waiting time grows exponentially. (Default: 5)'
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        help='Maximum number of keep-alive connections to Confluence. (Default: as many as requests can be issued concurrently)'
+    )
+    parser.add_argument(
+        '--check-auth',
+        action='store_true',
+        default=False,
+        help='Use this option to check the credentials with a separate request before doing anything else. Otherwise, they are checked with the first real request.'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        default=False,
+        help='Keep running and sync the markdown files (and new ones in the given directories) again whenever they or their attachments change. Only what has changed is uploaded.'
+    )
+    parser.add_argument(
+        '--watch-interval',
+        type=float,
+        default=1.0,
+        help='Seconds between two checks for changes when using --watch. (Default: 1)'
+    )
+    parser.add_argument(
+        '--debounce',
+        type=float,
+        default=0.5,
+        help='Changes are synced once the files have not changed for this many seconds when using --watch, so that a burst of saves is synced at once. (Default: 0.5)'
+    )
+    parser.add_argument(
+        '--manifest',
+        help='Path of a local JSON file that records the state of every markdown file and its attachments when it has been synced successfully. Only files that have changed since (or have not been synced before) are synced. Delete it to sync everything again, e.g., after pages have been changed in Confluence.'
+    )
+    parser.add_argument(
+        '--since',
+        metavar='REVISION',
+        help='Sync only the markdown files that differ from the given git revision (including uncommitted changes and new files), or whose attachments do according to --manifest.'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write metrics of the requests against Confluence (latency histograms, bytes sent and received, status codes and retries per endpoint) to this file in the Prometheus text format, e.g., into the directory of the textfile collector of the node exporter (name it *.prom then).'
+    )
+    parser.add_argument(
+        '--timing-report',
+        help='Write how long each phase (converting, looking up, uploading the page and its attachments) took for each markdown file to this JSON file.'
+    )
+    parser.add_argument(
+        '--profile',
+        help='Profile the run with cProfile and write the statistics to this file, e.g., to be read with "python -m pstats". (Conversions in other processes are not profiled, use --conversion-workers 1 to include them.)'
+    )
     args = parser.parse_args()
 
-    if not os.path.exists(args.markdownFile):
-        sys.exit(
-            'Error: Markdown file: "{}" does not exist.'.format(
-                os.path.abspath(args.markdownFile)
-            )
-        )
+    # the space key given after the markdown files is one of them for argparse, so
+    # it has to be told apart (a mistyped markdown file must not end up as the
+    # space key)
+    if not args.spacekey and len(args.markdownFiles) > 1 and looksLikeSpaceKey(args.markdownFiles[-1]):
+        args.spacekey = args.markdownFiles.pop()
+
+    if args.workers < 1 or args.attachment_workers < 1 \
+            or (args.pool_size is not None and args.pool_size < 1) \
+            or (args.conversion_workers is not None and args.conversion_workers < 1):
+        sys.exit('Error: The number of workers and connections has to be at least 1.')
+
+    if args.split_level is not None and not 2 <= args.split_level <= 6:
+        sys.exit('Error: The split level has to be between 2 and 6, as the first <h1> is the title.')
+
+    if args.cache_size < 1:
+        sys.exit('Error: The conversion cache has to be at least 1 MB large.')
+
+    if (args.rate_limit is not None and args.rate_limit <= 0) or args.max_retries < 0:
+        sys.exit('Error: The rate limit has to be positive and the number of retries must not be negative.')
+
+    if args.recursive and not args.delete:
+        sys.exit('Error: --recursive only applies to deleting pages (-d).')
+
+    if args.watch and args.delete:
+        sys.exit('Error: Pages cannot be deleted in watch mode.')
+
+    if args.watch_interval <= 0 or args.debounce < 0:
+        sys.exit('Error: The watch interval has to be positive and the debounce time must not be negative.')
+
+    # watch mode looks for new files in the same places
+    args.markdownPaths = args.markdownFiles
+    try:
+        args.markdownFiles = collectMarkdownFiles(args.markdownFiles)
+    except Exception as e:
+        sys.exit('Error: {}'.format(e))
+
+    if not args.markdownFiles:
+        sys.exit('Error: No markdown files found.')
 
     if not all([args.username, args.password]) or (not args.orgname and not args.force_wiki_url):
         print(
@@ -108,7 +260,26 @@ if __name__ == "__main__":
             'Spacekey not provided. I will use your username "{}" instead. Fingers crossed that this will somehow work, too.'.format(args.username))
         args.spacekey = args.username
 
+    # imported as late as possible, as loading the converter and requests takes
+    # most of the startup time (and is not needed for --help or usage errors)
+    from MarkdownConfluenceSync import MarkdownConfluenceSync
+
+    profiler = None
+    if args.profile:
+        from ThreadProfiler import ThreadProfiler
+        profiler = ThreadProfiler()
+        profiler.start()
+
     try:
-        MarkdownConfluenceSync(args).run()
+        markdownConfluenceSync = MarkdownConfluenceSync(args)
+        if args.watch:
+            markdownConfluenceSync.watch()
+        else:
+            markdownConfluenceSync.run()
     except Exception as e:
         print(e)
+        # e.g., a CI job has to notice that some of the pages have not been synced
+        sys.exit(1)
+    finally:
+        if profiler is not None:
+            profiler.stop(args.profile)